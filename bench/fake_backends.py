@@ -0,0 +1,107 @@
+# Fake backends for the benchmark: an HF-style inference server and a Telegram Bot API session.
+# Run directly to serve only the fake inference API: python bench/fake_backends.py --port 9000 --latency-ms 300
+import asyncio, json, random, time, itertools, argparse
+from collections import Counter
+from aiohttp import web
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message
+
+# --- Fake inference server ---
+class FakeInference:
+    # Answers like the HF Inference API / TGI: [{"generated_text"}] per input, a list of those for
+    # batched inputs, server-sent events when "stream" is set, and 503 "loading" at error_rate
+    def __init__(self, latency=0.3, jitter=0.3, error_rate=0.0, tokens=60, token_delay=0.01):
+        self.latency, self.jitter, self.error_rate = latency, jitter, error_rate
+        self.tokens, self.token_delay = tokens, token_delay
+        self.stats = Counter()
+
+    def _delay(self):
+        return max(0.0, random.gauss(self.latency, self.latency * self.jitter))
+
+    def _text(self, prompt):
+        words = ['insight', 'warm', 'curious', 'steady', 'open', 'kind', 'bold', 'calm']
+        return f"{prompt[:40]} -> " + ' '.join(random.choice(words) for _ in range(self.tokens))
+
+    async def handle(self, request):
+        payload = await request.json()
+        inputs = payload.get('inputs')
+        self.stats['requests'] += 1
+        if random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            await asyncio.sleep(self._delay() / 4)
+            return web.json_response({'error': 'Model is currently loading', 'estimated_time': 0.5}, status=503)
+        if isinstance(inputs, list):
+            self.stats['batches'] += 1
+            self.stats['batched_inputs'] += len(inputs)
+            await asyncio.sleep(self._delay() * (1 + 0.1 * len(inputs)))
+            return web.json_response([[{'generated_text': self._text(p)}] for p in inputs])
+        if payload.get('stream'):
+            self.stats['streams'] += 1
+            resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+            await resp.prepare(request)
+            await asyncio.sleep(self._delay() / 3)  # time to first token
+            words = self._text(inputs).split(' ')
+            for i, w in enumerate(words):
+                ev = {'token': {'text': w + ' ', 'special': False}, 'generated_text': None}
+                if i == len(words) - 1: ev['generated_text'] = ' '.join(words)
+                await resp.write(b'data:' + json.dumps(ev).encode() + b'\n\n')
+                await asyncio.sleep(self.token_delay)
+            await resp.write_eof()
+            return resp
+        await asyncio.sleep(self._delay())
+        return web.json_response([{'generated_text': self._text(inputs)}])
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        app.router.add_post('/{tail:.*}', self.handle)
+        return app
+
+    async def serve(self, port, host='127.0.0.1'):
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+# --- Fake Telegram session ---
+class FakeTelegramSession(BaseSession):
+    # Replaces the HTTP session of a Bot: every API call succeeds after `latency` seconds and
+    # message-returning methods get a plausible Message back
+    MESSAGE_METHODS = {'SendMessage', 'EditMessageText', 'SendDocument', 'SendPhoto'}
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self.time = 0.0
+        self._ids = itertools.count(1)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        if False:
+            yield b''
+
+    async def make_request(self, bot, method, timeout=None):
+        t0 = time.perf_counter()
+        name = type(method).__name__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.time += time.perf_counter() - t0
+        if name in self.MESSAGE_METHODS:
+            chat_id = int(getattr(method, 'chat_id', None) or 1)
+            return Message.model_validate({'message_id': next(self._ids), 'date': int(time.time()),
+                                           'chat': {'id': chat_id, 'type': 'private'},
+                                           'text': getattr(method, 'text', None)}, context={'bot': bot})
+        return True
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Fake HF inference server')
+    ap.add_argument('--port', type=int, default=9000)
+    ap.add_argument('--latency-ms', type=float, default=300)
+    ap.add_argument('--error-rate', type=float, default=0.0)
+    args = ap.parse_args()
+    fake = FakeInference(args.latency_ms / 1000, error_rate=args.error_rate)
+    web.run_app(fake.app(), host='127.0.0.1', port=args.port)
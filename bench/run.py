@@ -0,0 +1,236 @@
+# Load test for bot.py: synthetic Telegram updates are fed straight into `dp` with a fake Bot API
+# session, HF_API_URL points at a local fake inference server, and the data files are pre-filled.
+#   python bench/run.py --users 1k,100k,1m --updates 5000 --concurrency 200 --latency-ms 300
+#   python bench/run.py --users 100k --baseline bench/results/<earlier run>.json --fail-on-regression
+# Each scale runs in its own process (bot.py loads its state at import). Results go to bench/results/.
+import os, sys, json, time, random, socket, asyncio, argparse, tempfile, subprocess, resource, datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+RESULTS_DIR = os.path.join(HERE, 'results')
+ADMIN = 1
+BENCH_TOKEN = '123456:BENCHMARK-TOKEN'
+
+# weights of the synthetic traffic; 'start' is the /start command, the rest are callback_data
+MIX = {'start': 10, 'mini': 15, 'compat': 8, 'advice': 8, 'status': 10, 'premium': 8, 'deep_portrait': 4,
+       'buy': 5, 'lang': 4, 'set_lang': 5, 'back': 5, 'i_paid': 2, 'adm_stats': 3, 'adm_users': 2, 'adm_orders': 2}
+
+def parse_scale(v):
+    v = v.strip().lower()
+    mult = {'k': 1000, 'm': 1000000}.get(v[-1], 1)
+    return int(float(v.rstrip('km')) * mult)
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def populate(data_dir, users, seed=1):
+    # users.json at the requested scale plus one order per ten users
+    rnd = random.Random(seed)
+    now = int(time.time())
+    t0 = time.perf_counter()
+    with open(os.path.join(data_dir, 'users.json'), 'w', encoding='utf-8') as f:
+        f.write('{')
+        for i in range(users):
+            uid = 1000 + i
+            premium = rnd.random() < 0.1
+            u = {'trial_left': rnd.choice([0, 1, 2]), 'premium': premium,
+                 'premium_until': now + rnd.randint(60, 30 * 86400) if premium else 0,
+                 'lang': rnd.choice(['ru', 'en', 'kz']), 'requests': rnd.randint(0, 50)}
+            f.write(('' if i == 0 else ',') + json.dumps(str(uid)) + ':' + json.dumps(u))
+        f.write('}')
+    with open(os.path.join(data_dir, 'orders.jsonl'), 'w', encoding='utf-8') as f:
+        for i in range(users // 10):
+            uid = 1000 + rnd.randrange(users)
+            f.write(json.dumps({'id': f'man_{now - i}_{uid}', 'telegram_id': str(uid), 'timestamp': now - i,
+                                'status': rnd.choice(['pending', 'approved', 'rejected'])}) + '\n')
+    return time.perf_counter() - t0
+
+def percentiles(xs):
+    if not xs: return {'n': 0}
+    xs = sorted(xs)
+    pick = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))] * 1000
+    return {'n': len(xs), 'p50_ms': round(pick(0.5), 3), 'p95_ms': round(pick(0.95), 3),
+            'p99_ms': round(pick(0.99), 3), 'max_ms': round(xs[-1] * 1000, 3)}
+
+def make_update(kind, uid, update_id):
+    user = {'id': uid, 'is_bot': False, 'first_name': f'User{uid}', 'username': f'user{uid}'}
+    chat = {'id': uid, 'type': 'private'}
+    if kind == 'start':
+        return {'update_id': update_id, 'message': {'message_id': update_id, 'date': int(time.time()),
+                                                    'chat': chat, 'from': user, 'text': '/start'}}
+    data = {'set_lang': 'set_lang_' + random.choice(['ru', 'en', 'kz'])}.get(kind, kind)
+    msg = {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'text': 'menu'}
+    return {'update_id': update_id, 'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': '1',
+                                                       'data': data, 'message': msg}}
+
+# --- One scale, in-process ---
+async def run_single(args):
+    from fake_backends import FakeInference, FakeTelegramSession
+    fake = FakeInference(args.latency_ms / 1000, error_rate=args.error_rate)
+    runner = await fake.serve(args.hf_port)
+
+    rss0 = rss_mb()
+    t0 = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    import bot as app
+    load_time = time.perf_counter() - t0
+    rss_loaded = rss_mb()
+
+    session = FakeTelegramSession(args.tg_latency_ms / 1000)
+    session.middleware(app.BotCallTiming())
+    app.bot.session = session
+    io = {'users_flush': [], 'orders_append': []}
+    def timed(fn, key):
+        def wrapper(*a, **kw):
+            t = time.perf_counter()
+            try:
+                return fn(*a, **kw)
+            finally:
+                io[key].append(time.perf_counter() - t)
+        return wrapper
+    app.users_store.flush = timed(app.users_store.flush, 'users_flush')
+    app.orders_journal._append = timed(app.orders_journal._append, 'orders_append')
+    await app.dp.emit_startup(bot=app.bot)
+
+    ids = [ADMIN] + [1000 + i for i in range(args.users)]
+    kinds, weights = zip(*MIX.items())
+    rnd = random.Random(args.seed)
+    lat = {}
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one(n):
+        kind = rnd.choices(kinds, weights)[0]
+        uid = ADMIN if kind.startswith('adm_') else rnd.choice(ids)
+        update = app.types.Update.model_validate(make_update(kind, uid, n), context={'bot': app.bot})
+        async with sem:
+            t = time.perf_counter()
+            try:
+                await app.dp.feed_update(app.bot, update)
+            except Exception as e:
+                lat.setdefault('errors', []).append(repr(e))
+            lat.setdefault(kind, []).append(time.perf_counter() - t)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(1, args.updates + 1)))
+    wall = time.perf_counter() - t0
+    app.users_store.flush()
+    await app.dp.emit_shutdown(bot=app.bot)
+    await runner.cleanup()
+
+    errors = lat.pop('errors', [])
+    all_lat = [x for xs in lat.values() for x in xs]
+    return {
+        'version': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'params': {k: v for k, v in vars(args).items() if k not in ('single', 'hf_port', 'baseline', 'fail_on_regression', 'scales')},
+        'load_s': round(load_time, 3),
+        'updates_per_s': round(args.updates / wall, 1),
+        'wall_s': round(wall, 3),
+        'overall': percentiles(all_lat),
+        'handlers': {k: percentiles(v) for k, v in sorted(lat.items())},
+        'errors': len(errors), 'error_samples': errors[:5],
+        'io': {k: dict(percentiles(v), total_ms=round(sum(v) * 1000, 3)) for k, v in io.items()},
+        'telegram_calls': dict(session.calls),
+        'inference': dict(fake.stats),
+        'memory_mb': {'before_import': round(rss0, 1), 'after_load': round(rss_loaded, 1), 'after_run': round(rss_mb(), 1)},
+    }
+
+# --- Reporting ---
+def compare(result, baseline, threshold):
+    # regressions: p95 per handler and overall throughput worse than the baseline by > threshold
+    bad = []
+    for name, cur in result['handlers'].items():
+        old = baseline.get('handlers', {}).get(name)
+        if old and old.get('p95_ms') and cur.get('p95_ms', 0) > old['p95_ms'] * (1 + threshold):
+            bad.append(f"{name}: p95 {old['p95_ms']}ms -> {cur['p95_ms']}ms")
+    if baseline.get('updates_per_s') and result['updates_per_s'] < baseline['updates_per_s'] * (1 - threshold):
+        bad.append(f"throughput {baseline['updates_per_s']}/s -> {result['updates_per_s']}/s")
+    return bad
+
+def report(r):
+    print(f"\n== {r['params']['users']} users, {r['params']['updates']} updates @ {r['params']['concurrency']} concurrent ({r['version']})")
+    print(f"load {r['load_s']}s, {r['updates_per_s']} updates/s, errors {r['errors']}, memory {r['memory_mb']}")
+    o = r['overall']
+    print(f"overall p50 {o.get('p50_ms')}ms p95 {o.get('p95_ms')}ms p99 {o.get('p99_ms')}ms")
+    for name, p in r['handlers'].items():
+        print(f"  {name:<14} n={p['n']:<6} p50={p['p50_ms']:<9} p95={p['p95_ms']:<9} p99={p['p99_ms']}")
+    for name, p in r['io'].items():
+        if p['n']: print(f"  io {name:<14} n={p['n']:<6} p95={p['p95_ms']}ms total={p['total_ms']}ms")
+    print(f"  telegram calls {r['telegram_calls']}\n  inference {r['inference']}")
+
+def run_scale(args, users):
+    # a fresh process per scale: data dir, env and bot import are all per run
+    with tempfile.TemporaryDirectory(prefix='lovesense-bench-') as tmp:
+        data_dir, logs_dir = os.path.join(tmp, 'data'), os.path.join(tmp, 'logs')
+        os.makedirs(data_dir); os.makedirs(logs_dir)
+        print(f"populating {users} users ...", flush=True)
+        populate(data_dir, users, args.seed)
+        port = free_port()
+        env = dict(os.environ, TELEGRAM_TOKEN=BENCH_TOKEN, ADMIN_ID=str(ADMIN), DATA_DIR=data_dir, LOGS_DIR=logs_dir,
+                   HF_API_URL=f'http://127.0.0.1:{port}/', HF_API_KEY='bench', AI_STREAM='1' if args.stream else '0')
+        if not args.keep_rate_limits:
+            env.update(AI_USER_RATE='1000', AI_USER_BURST='1000', AI_GLOBAL_RATE='100000', AI_GLOBAL_BURST='100000')
+        out = os.path.join(tmp, 'result.json')
+        cmd = [sys.executable, os.path.abspath(__file__), '--single', out, '--users', str(users), '--hf-port', str(port),
+               '--updates', str(args.updates), '--concurrency', str(args.concurrency), '--latency-ms', str(args.latency_ms),
+               '--tg-latency-ms', str(args.tg_latency_ms), '--error-rate', str(args.error_rate), '--seed', str(args.seed)]
+        if args.stream: cmd.append('--stream')
+        subprocess.run(cmd, env=env, cwd=tmp, check=True)
+        with open(out) as f:
+            return json.load(f)
+
+def main():
+    ap = argparse.ArgumentParser(description='LoveSense bot load test')
+    ap.add_argument('--users', dest='scales', default='1k', help='comma separated scales, e.g. 1k,100k,1m')
+    ap.add_argument('--updates', type=int, default=2000)
+    ap.add_argument('--concurrency', type=int, default=100)
+    ap.add_argument('--latency-ms', type=float, default=300, help='mean fake inference latency')
+    ap.add_argument('--tg-latency-ms', type=float, default=20, help='fake Bot API latency per call')
+    ap.add_argument('--error-rate', type=float, default=0.02, help='share of inference calls answered with 503')
+    ap.add_argument('--stream', action='store_true', help='stream AI answers (AI_STREAM=1)')
+    ap.add_argument('--keep-rate-limits', action='store_true', help="keep bot.py's per-user/global AI rate limits")
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--baseline', help='earlier result JSON to compare against')
+    ap.add_argument('--threshold', type=float, default=0.10, help='allowed relative regression')
+    ap.add_argument('--fail-on-regression', action='store_true')
+    ap.add_argument('--single', help=argparse.SUPPRESS)
+    ap.add_argument('--hf-port', type=int, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.single:
+        args.users = parse_scale(args.scales)
+        sys.path.insert(0, HERE)
+        result = asyncio.run(run_single(args))
+        with open(args.single, 'w') as f:
+            json.dump(result, f, indent=2)
+        os._exit(0)  # skip bot.py's atexit flush of a throwaway data dir
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    failed = []
+    for scale in args.scales.split(','):
+        r = run_scale(args, parse_scale(scale))
+        report(r)
+        name = f"{r['date'].replace(':', '')}-{r['version'] or 'nogit'}-{r['params']['users']}.json"
+        with open(os.path.join(RESULTS_DIR, name), 'w') as f:
+            json.dump(r, f, indent=2)
+        print(f"saved bench/results/{name}")
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            bad = compare(r, baseline, args.threshold)
+            for line in bad: print(f"  REGRESSION {line}")
+            failed += bad
+    if failed and args.fail_on_regression:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
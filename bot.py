@@ -1,9 +1,13 @@
-# Improved LoveSense AI - integrated: trial, premium, admin panel, logs, orders, Flask API
-import os, asyncio, json, time, requests, logging, datetime
+# Improved LoveSense AI - integrated: trial, premium, admin panel, logs, orders, HTTP API
+import os, sys, signal, socket, asyncio, json, sqlite3, gzip, shutil, queue, time, random, hashlib, aiohttp, logging, datetime, threading, atexit, contextlib, bisect, itertools
+from collections import OrderedDict, Counter, deque
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
-from flask import Flask, jsonify, request as flask_request
 from threading import Thread
 
 # --- Config ---
@@ -15,24 +19,371 @@ LOGS_DIR = os.getenv('LOGS_DIR', 'logs')
 
 USERS_FILE = os.path.join(DATA_DIR, 'users.json')
 ORDERS_FILE = os.path.join(DATA_DIR, 'orders.json')
-ACTIONS_LOG = os.path.join(LOGS_DIR, 'actions.log')
+# actions.log rotation renames the file under its writers, so processes sharing LOGS_DIR (see
+# PROCESS_ROLE) must each set a distinct LOG_INSTANCE, e.g. bot-1, api-1, and write actions.<instance>.log
+LOG_INSTANCE = os.getenv('LOG_INSTANCE', '')
+ACTIONS_LOG = os.path.join(LOGS_DIR, f'actions.{LOG_INSTANCE}.log' if LOG_INSTANCE else 'actions.log')
 ERRORS_LOG = os.path.join(LOGS_DIR, 'errors.log')
+USERS_JOURNAL = os.path.join(DATA_DIR, 'users.journal')
+ORDERS_JOURNAL = os.path.join(DATA_DIR, 'orders.jsonl')
+
+# users.json is kept in memory and flushed in the background every USERS_FLUSH_INTERVAL seconds.
+# USERS_DURABILITY: 'fsync' - journal every change and fsync it, 'journal' - journal without fsync,
+# 'lazy' - no journal, changes since the last flush are lost on crash
+USERS_FLUSH_INTERVAL = float(os.getenv('USERS_FLUSH_INTERVAL', 5))
+USERS_DURABILITY = os.getenv('USERS_DURABILITY', 'journal')
+# with a journal, a flush rewrites users.json only once the journal holds USERS_SNAPSHOT_RATIO
+# times as many records as there are users (at least 10000); until then the journal is the copy
+USERS_SNAPSHOT_RATIO = float(os.getenv('USERS_SNAPSHOT_RATIO', 1))
+# STATE_BACKEND=sqlite keeps users and orders in one SQLite database in WAL mode (STATE_DB) that
+# several bot/API processes share, instead of the JSON files owned by a single process. Each
+# process holds a pool of SQLITE_POOL_SIZE connections. Store calls run on the event loop, so a
+# writer waits at most SQLITE_BUSY_TIMEOUT seconds for another process's transaction, retried
+# SQLITE_BUSY_RETRIES times with a short jittered pause, before the call fails.
+# Import the JSON files once with: python bot.py migrate-sqlite
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'json')
+STATE_DB = os.getenv('STATE_DB', os.path.join(DATA_DIR, 'state.db'))
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', 4))
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 0.1))
+SQLITE_BUSY_RETRIES = int(os.getenv('SQLITE_BUSY_RETRIES', 3))
+# PROCESS_ROLE: 'all' - bot and HTTP API, 'bot' - Telegram updates only (plus /metrics), 'api' - HTTP
+# API only. Run one polling process, or any number of webhook/API processes with the sqlite backend;
+# SERVER_REUSE_PORT=1 lets processes on one host share PORT (Linux SO_REUSEPORT)
+PROCESS_ROLE = os.getenv('PROCESS_ROLE', 'all')
+SERVER_REUSE_PORT = os.getenv('SERVER_REUSE_PORT', '0') == '1'
+# actions.log is JSON lines written in batches by a background thread; it rotates at ACTIONS_LOG_MAX_MB
+# or every ACTIONS_LOG_ROTATE_HOURS, old segments are gzipped and the newest ACTIONS_LOG_KEEP are kept
+ACTIONS_LOG_MAX_MB = float(os.getenv('ACTIONS_LOG_MAX_MB', 20))
+ACTIONS_LOG_ROTATE_HOURS = float(os.getenv('ACTIONS_LOG_ROTATE_HOURS', 24))
+ACTIONS_LOG_KEEP = int(os.getenv('ACTIONS_LOG_KEEP', 14))
+# PROFILER_ENABLED=1 allows the admin to start/stop the sampling profiler over HTTP (/debug/profiler)
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', '0') == '1'
+# /admin/grant applies a list of ids ADMIN_GRANT_CHUNK at a time, each chunk in its own short
+# transaction (or hold of the JSON store locks), so user updates interleave with a large grant
+ADMIN_GRANT_CHUNK = int(os.getenv('ADMIN_GRANT_CHUNK', 100))
+# orders.jsonl is compacted on startup once it holds this many times more lines than live orders
+ORDERS_COMPACT_RATIO = float(os.getenv('ORDERS_COMPACT_RATIO', 2))
 
 CARD_NUMBER = "4400 4302 7114 7016"
 CARD_OWNER = "Andrey.G"
 PRICE_STR = "2500 ₸ / месяц"
 
+# BOT_MODE=webhook receives updates on the API server instead of long polling. Updates wait in a
+# queue of UPDATE_QUEUE_SIZE (Telegram gets a 503 and retries when it is full) drained by
+# UPDATE_WORKERS tasks; on shutdown the queue is drained for up to DRAIN_TIMEOUT seconds
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/tg/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 64))
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', 30))
+
+# Expired premiums are revoked in batches of EXPIRY_BATCH and owners get a renewal reminder,
+# at most REMINDER_RATE messages per second
+EXPIRY_BATCH = int(os.getenv('EXPIRY_BATCH', 500))
+REMINDER_RATE = float(os.getenv('REMINDER_RATE', 10))
+# Broadcasts and notifications go out at most BROADCAST_RATE messages/s in total and BROADCAST_CHAT_RATE
+# per chat, BROADCAST_CONCURRENCY at a time. A broadcast walks the user store in batches of
+# BROADCAST_BATCH and checkpoints after each (broadcast.json, or the database with the sqlite
+# backend), so a restart resumes it (at most one batch is sent twice after a crash). One process
+# sends a job at a time; with several processes another one takes over after its owner stops
+BROADCAST_FILE = os.path.join(DATA_DIR, 'broadcast.json')
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_CHAT_RATE = float(os.getenv('BROADCAST_CHAT_RATE', 1))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 16))
+BROADCAST_BATCH = int(os.getenv('BROADCAST_BATCH', 200))
+
+# --- AI backend ---
+HF_API_URL = os.getenv('HF_API_URL','https://api-inference.huggingface.co/models/Qwen/Qwen2.5-7B-Instruct')
+HF_API_KEY = os.getenv('HF_API_KEY')
+AI_CONCURRENCY = int(os.getenv('AI_CONCURRENCY', 8))      # requests in flight to HF_API_URL
+AI_QUEUE_LIMIT = int(os.getenv('AI_QUEUE_LIMIT', 100))    # requests allowed to wait for a slot, the rest are shed
+AI_DEADLINE = float(os.getenv('AI_DEADLINE', 25))         # seconds per generation, including queueing and retries
+AI_RETRIES = int(os.getenv('AI_RETRIES', 3))              # retries on 503 "model is loading"
+AI_BACKOFF_MAX = float(os.getenv('AI_BACKOFF_MAX', 8))
+# Concurrent prompts are coalesced for AI_BATCH_WINDOW_MS (or until AI_BATCH_MAX) into one request
+# with a list of inputs; AI_BATCH_MAX=1 disables batching but keeps deduplication of identical prompts
+AI_BATCH_WINDOW_MS = float(os.getenv('AI_BATCH_WINDOW_MS', 40))
+AI_BATCH_MAX = int(os.getenv('AI_BATCH_MAX', 8))
+# if the endpoint refuses list inputs (400/422), batching pauses for AI_BATCH_COOLDOWN seconds
+AI_BATCH_COOLDOWN = float(os.getenv('AI_BATCH_COOLDOWN', 600))
+
+# Answers are streamed into the chat with edits at most every AI_STREAM_EDIT_INTERVAL seconds per
+# message and AI_STREAM_EDITS_PER_SEC across all chats; AI_STREAM=0 sends the whole answer at once
+AI_STREAM = os.getenv('AI_STREAM', '1') == '1'
+AI_STREAM_EDIT_INTERVAL = float(os.getenv('AI_STREAM_EDIT_INTERVAL', 1.0))
+AI_STREAM_EDITS_PER_SEC = float(os.getenv('AI_STREAM_EDITS_PER_SEC', 20))
+# if the endpoint does not stream (refuses stream=True or answers with plain JSON), replies go through
+# the batcher for AI_STREAM_COOLDOWN seconds; a 429/5xx on a stream is reported, not retried one-shot
+AI_STREAM_COOLDOWN = float(os.getenv('AI_STREAM_COOLDOWN', 600))
+
+# One generation per user at a time, plus token buckets (tokens/sec, burst) per user and overall
+AI_USER_RATE = float(os.getenv('AI_USER_RATE', 0.2))
+AI_USER_BURST = float(os.getenv('AI_USER_BURST', 3))
+AI_GLOBAL_RATE = float(os.getenv('AI_GLOBAL_RATE', 20))
+AI_GLOBAL_BURST = float(os.getenv('AI_GLOBAL_BURST', 40))
+
+# Generations are cached per feature, name and language: AI_CACHE_SIZE entries in memory and up to
+# AI_CACHE_DISK_MB on disk (0 disables the disk tier). TTLs are seconds, AI_CACHE_TTL_<FEATURE> overrides.
+AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', 2000))
+AI_CACHE_DISK_MB = float(os.getenv('AI_CACHE_DISK_MB', 50))
+AI_CACHE_DIR = os.path.join(DATA_DIR, 'ai_cache')
+AI_CACHE_TTL = {'mini': 7*86400, 'compat': 7*86400, 'advice': 6*3600,
+                'deep_portrait': 7*86400, 'relationship_pro': 7*86400, 'partner': 7*86400}
+AI_CACHE_TTL.update({f: int(os.environ[f'AI_CACHE_TTL_{f.upper()}']) for f in AI_CACHE_TTL if f'AI_CACHE_TTL_{f.upper()}' in os.environ})
+
 # --- Ensure directories ---
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(LOGS_DIR, exist_ok=True)
 
 # --- Logging ---
 logging.basicConfig(level=logging.INFO, filename=ERRORS_LOG, format='%(asctime)s %(levelname)s: %(message)s')
+
+class BatchLogHandler(logging.Handler):
+    # emit() only enqueues; a writer thread formats records as JSON lines, writes them in batches
+    # and rotates the file by size and age, gzipping finished segments
+    def __init__(self, path, max_bytes, max_age, keep, batch=500, interval=1.0):
+        super().__init__()
+        self.path, self.max_bytes, self.max_age, self.keep = path, max_bytes, max_age, keep
+        self.batch, self.interval = batch, interval
+        self.q = queue.SimpleQueue()
+        self.f = open(path, 'a', encoding='utf-8')
+        self.opened = self._started()
+        self._thread = Thread(target=self._run, name='actions-log', daemon=True)
+        self._thread.start()
+
+    def _started(self):
+        # the segment's age comes from its first record, so restarts don't reset the rotation clock
+        try:
+            with open(self.path, 'rb') as f:
+                return datetime.datetime.fromisoformat(json.loads(f.readline())['ts']).timestamp()
+        except (OSError, ValueError, KeyError, TypeError):
+            return time.time()
+
+    def emit(self, record):
+        self.q.put(record)
+
+    def _line(self, r):
+        rec = {'ts': datetime.datetime.fromtimestamp(r.created).isoformat(timespec='milliseconds'), 'event': r.getMessage()}
+        if getattr(r, 'uid', None) is not None: rec['uid'] = str(r.uid)
+        rec.update(getattr(r, 'data', None) or {})
+        return json.dumps(rec, ensure_ascii=False) + '\n'
+
+    def _run(self):
+        while True:
+            try:
+                r = self.q.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+            if r is None: return
+            records = [r]
+            while len(records) < self.batch:
+                try:
+                    r = self.q.get_nowait()
+                except queue.Empty:
+                    break
+                if r is None:
+                    self._write(records); return
+                records.append(r)
+            self._write(records)
+
+    def _write(self, records):
+        try:
+            if self.f.tell() and (self.f.tell() >= self.max_bytes or time.time() - self.opened >= self.max_age):
+                self._rotate()
+            self.f.write(''.join(self._line(r) for r in records))
+            self.f.flush()
+        except Exception:
+            logging.exception('actions log write')
+
+    def _rotate(self):
+        self.f.close()
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')  # fixed width, sorts by name too
+        seg = f'{self.path}.{stamp}'
+        n = 1
+        while os.path.exists(seg + '.gz'):
+            seg = f'{self.path}.{stamp}-{n}'; n += 1
+        os.replace(self.path, seg)
+        self.f = open(self.path, 'a', encoding='utf-8')
+        self.opened = time.time()
+        with open(seg, 'rb') as src, gzip.open(seg + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(seg)
+        # oldest first by mtime: names alone misorder same-second segments (stamp-1.gz < stamp.gz)
+        d, base = os.path.dirname(self.path) or '.', os.path.basename(self.path) + '.'
+        old = sorted((os.path.getmtime(os.path.join(d, e)), e) for e in os.listdir(d) if e.startswith(base) and e.endswith('.gz'))
+        for _, name in old[:-self.keep] if self.keep > 0 else []:
+            os.remove(os.path.join(d, name))
+
+    def close(self):
+        if self._thread.is_alive():
+            self.q.put(None)
+            self._thread.join(5)
+            self.f.close()
+        super().close()
+
 action_logger = logging.getLogger('actions')
 action_logger.setLevel(logging.INFO)
-ah = logging.FileHandler(ACTIONS_LOG, encoding='utf-8')
-ah.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
-action_logger.addHandler(ah)
+action_logger.propagate = False
+action_logger.addHandler(BatchLogHandler(ACTIONS_LOG, ACTIONS_LOG_MAX_MB * 1024 * 1024, ACTIONS_LOG_ROTATE_HOURS * 3600, ACTIONS_LOG_KEEP))
+
+def log_action(event, uid=None, **data):
+    action_logger.info(event, extra={'uid': uid, 'data': data})
+
+def tail_log(path, n, uid=None, block=65536):
+    # last n lines of `path` (optionally only those of one user), read backwards from the end
+    uid = None if uid is None else str(uid)
+    lines, buf = [], b''
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return []
+    with f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0 and len(lines) < n:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+            parts = buf.split(b'\n')
+            buf = parts[0]  # possibly incomplete, keep for the next block
+            for raw in reversed(parts[1:]):
+                if len(lines) >= n: break
+                if raw.strip() and _log_line_matches(raw, uid): lines.append(raw.decode('utf-8', 'replace'))
+        if pos == 0 and buf.strip() and len(lines) < n and _log_line_matches(buf, uid):
+            lines.append(buf.decode('utf-8', 'replace'))
+    return lines[::-1]
+
+def _log_line_matches(raw, uid):
+    if uid is None: return True
+    try:
+        return str(json.loads(raw).get('uid')) == uid
+    except (ValueError, AttributeError):
+        return uid.encode() in raw  # plain-text lines from before the JSON format
+
+# --- Metrics ---
+class Histogram:
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum, self.n = 0.0, 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.BUCKETS, v)] += 1
+        self.sum += v; self.n += 1
+
+class Metrics:
+    # Prometheus-style histograms and counters keyed by (name, labels); sampled metrics are
+    # callables read when /metrics is rendered: gauges for levels, counters for totals kept
+    # elsewhere. Counters get the _total suffix. Observed from the loop and the flush/log threads.
+    def __init__(self, prefix='lovesense'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.hists, self.counters, self.sampled = {}, {}, {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.hists.get(key)
+            if h is None: h = self.hists[key] = Histogram()
+            h.observe(value)
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def gauge(self, name, fn, label='kind'):
+        # fn() returns a number or a {label value: number} dict
+        self.sampled[name] = ('gauge', fn, label)
+
+    def counter(self, name, fn, label='kind'):
+        # like gauge(), for values that only go up (reset on restart at most)
+        self.sampled[name + '_total'] = ('counter', fn, label)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items: return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+    def render(self):
+        out, p = [], self.prefix
+        with self.lock:
+            hists, counters = sorted(self.hists.items()), sorted(self.counters.items())
+            hists = [(k, (list(h.counts), h.sum, h.n)) for k, h in hists]
+        seen = set()
+        for (name, labels), (counts, total, n) in hists:
+            if name not in seen:
+                out.append(f'# TYPE {p}_{name} histogram'); seen.add(name)
+            acc = 0
+            for le, c in zip(list(Histogram.BUCKETS) + ['+Inf'], counts):
+                acc += c
+                out.append(f'{p}_{name}_bucket{self._labels(labels, [("le", le)])} {acc}')
+            out.append(f'{p}_{name}_sum{self._labels(labels)} {total:.6f}')
+            out.append(f'{p}_{name}_count{self._labels(labels)} {n}')
+        for (name, labels), v in counters:
+            if name not in seen:
+                out.append(f'# TYPE {p}_{name}_total counter'); seen.add(name)
+            out.append(f'{p}_{name}_total{self._labels(labels)} {v}')
+        for name, (kind, fn, label) in sorted(self.sampled.items()):
+            try:
+                v = fn()
+            except Exception:
+                logging.exception('metric %s', name); continue
+            out.append(f'# TYPE {p}_{name} {kind}')
+            for lv, val in (v.items() if isinstance(v, dict) else [(None, v)]):
+                out.append(f'{p}_{name}{self._labels([(label, lv)] if lv is not None else [])} {float(val)}')
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+
+class SamplingProfiler:
+    # Samples the event loop thread's stack every `interval` seconds from a side thread and
+    # counts collapsed stacks ("file:func;file:func ..."), the input format of flamegraph tools
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = {}
+        self.target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, target_thread_id):
+        if self._thread and self._thread.is_alive(): return False
+        self.samples, self.target = {}, target_thread_id
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def dump(self, top=50):
+        items = sorted(self.samples.items(), key=lambda kv: -kv[1])[:top]
+        return '\n'.join(f'{stack} {n}' for stack, n in items) + '\n'
+
+profiler = SamplingProfiler()
 
 # --- I18n ---
 LANGS = {'en':'🇬🇧 English','ru':'🇷🇺 Русский','kz':'🇰🇿 Қазақша'}
@@ -42,9 +393,33 @@ I18N = {
   'choose_lang':{'en':'Choose language','ru':'Выберите язык','kz':'Тілді таңдаңыз'},
   'mini':{'en':'Generating mini-analysis...','ru':'Генерируется мини-анализ...','kz':'Мини-талдау жасалып жатыр...'},
   'premium_active':{'en':'You have Premium ✅','ru':'У вас есть Premium ✅','kz':'Сізде Premium бар ✅'},
-  'no_premium':{'en':'No active Premium. Buy to unlock.','ru':'Нет активного Premium. Купите, чтобы разблокировать.','kz':'Premium белсенді емес. Сатып алыңыз'}
+  'no_premium':{'en':'No active Premium. Buy to unlock.','ru':'Нет активного Premium. Купите, чтобы разблокировать.','kz':'Premium белсенді емес. Сатып алыңыз'},
+  'btn_mini':{'en':'🧠 Mini personality','ru':'🧠 Мини-анализ','kz':'🧠 Мини-талдау'},
+  'btn_compat':{'en':'❤️ Compatibility','ru':'❤️ Совместимость','kz':'❤️ Сәйкестік'},
+  'btn_advice':{'en':'🔮 AI Advice','ru':'🔮 Совет AI','kz':'🔮 AI кеңес'},
+  'btn_premium':{'en':'💎 Premium analysis','ru':'💎 Премиум анализ','kz':'💎 Премиум талдау'},
+  'btn_buy':{'en':'💳 Buy Premium','ru':'💳 Купить Premium','kz':'💳 Premium сатып алу'},
+  'btn_status':{'en':'📊 My status','ru':'📊 Мой статус','kz':'📊 Жағдайым'},
+  'btn_lang':{'en':'🌐 Language','ru':'🌐 Язык','kz':'🌐 Тіл'},
+  'btn_deep':{'en':'🧠 Deep portrait','ru':'🧠 Глубокий портрет','kz':'🧠 Терең портрет'},
+  'btn_relpro':{'en':'❤️ Relationship PRO','ru':'❤️ Relationship PRO','kz':'❤️ Relationship PRO'},
+  'btn_partner':{'en':'🔍 Partner analysis','ru':'🔍 Разбор партнёра','kz':'🔍 Серіктес талдауы'},
+  'btn_back_menu':{'en':'🔁 Back','ru':'🔁 Назад','kz':'🔁 Артқа'},
+  'btn_back':{'en':'Back','ru':'Назад','kz':'Артқа'},
+  'premium_expired':{'en':'Your Premium has expired. Renew it to keep full access 💎','ru':'Ваш Premium закончился. Продлите его, чтобы сохранить полный доступ 💎','kz':'Premium мерзімі аяқталды. Толық қолжетімділік үшін ұзартыңыз 💎'},
 }
 
+def validate_i18n():
+    # startup check: every string must exist in every language, gaps are logged and served in DEFAULT_LANG
+    missing = [(k, l) for k, v in I18N.items() for l in LANGS if not v.get(l)]
+    for k, l in missing:
+        logging.error('i18n: %s has no %s translation', k, l)
+    return missing
+
+def tr(key, lang):
+    v = I18N[key]
+    return v.get(lang) or v[DEFAULT_LANG]
+
 # --- Helpers for JSON files ---
 def read_json(path):
     try:
@@ -52,15 +427,748 @@ def read_json(path):
     except Exception:
         return {} if path.endswith('.json') and os.path.basename(path)!='orders.json' else []
 
-def write_json(path,obj):
-    with open(path,'w',encoding='utf-8') as f:
-        json.dump(obj,f,ensure_ascii=False,indent=2)
+def fsync_dir(path):
+    # makes a rename inside the directory of `path` durable (no-op where directories can't be opened)
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_json(path,obj,indent=2,fsync=False):
+    # write to a temp file and rename, so a crash never leaves a half-written file behind
+    tmp = path + '.tmp'
+    with open(tmp,'w',encoding='utf-8') as f:
+        # json.dumps, unlike json.dump, uses the C encoder (when indent is None)
+        f.write(json.dumps(obj,ensure_ascii=False,indent=indent))
+        if fsync:
+            f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path)
+    if fsync: fsync_dir(path)
+
+# --- User store ---
+DEFAULT_USER = {"trial_left":2, "premium": False, "premium_until":0, "lang": DEFAULT_LANG, "requests": 0}
+
+def new_user():
+    return dict(DEFAULT_USER)
+
+class UserStore:
+    # Users live in memory; every change is appended to a journal (replayed on startup). The
+    # background thread rewrites the users.json snapshot and truncates the journal only once the
+    # journal has grown past snapshot_ratio x users records; with durability 'lazy' there is no
+    # journal, so it writes the snapshot whenever something changed.
+    # Records are replaced, never mutated in place, so a shallow copy is a consistent snapshot.
+    # Admin counters are kept up to date on every change, and premium expiry is a sorted
+    # (premium_until, id) list, so "active now" is one bisect. Requests per feature are counted
+    # in counts['requests'], journaled as absolute values and saved next to the snapshot.
+    MIN_SNAPSHOT_RECORDS = 10000
+
+    def __init__(self, path, journal_path, flush_interval=5, durability='journal', snapshot_ratio=1):
+        self.path, self.journal_path = path, journal_path
+        self.counters_path = os.path.splitext(path)[0] + '.counters.json'
+        self.flush_interval, self.durability = flush_interval, durability
+        self.snapshot_ratio = snapshot_ratio
+        self.journal_records = 0  # records in the journal since the last snapshot
+        self.lock = threading.RLock()
+        self.users = {}
+        self.order = []  # ids in insertion order, so page_ids can index by position
+        self.dirty = set()
+        self.requests_dirty = False
+        self.counts = {'total': 0, 'trial_left': 0, 'requests': {}}
+        self.premium_index = []
+        self._journal = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.load()
+
+    def load(self):
+        with self.lock:
+            self.users = read_json(self.path) or {}
+            requests = read_json(self.counters_path).get('requests') or {}
+            replayed = good = 0
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'rb') as f:
+                    for line in f:
+                        try:
+                            if not line.endswith(b'\n'): raise ValueError
+                            rec = json.loads(line)
+                        except ValueError:
+                            break  # torn write at the tail after a crash
+                        if 'counter' in rec:
+                            requests[rec['counter']] = rec['value']
+                        else:
+                            self.users[rec['id']] = rec['user']
+                        replayed += 1
+                        good += len(line)
+            if not os.path.exists(self.path):
+                write_json(self.counters_path, {'requests': requests}, indent=None, fsync=True)
+                write_json(self.path, self.users, indent=None, fsync=True)
+            self.counts = {'total': 0, 'trial_left': 0, 'requests': requests}
+            self.premium_index = []
+            self.order = list(self.users)
+            for key, u in self.users.items():
+                self._account(key, None, u)
+            # keep appending to the replayed journal; a torn tail is cut so new records stay readable
+            self._journal = open(self.journal_path, 'ab')
+            self._journal.truncate(good)
+            self.journal_records = replayed
+            if replayed:
+                logging.info('users: replayed %s journal records', replayed)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._flush_loop, name='users-flush', daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('users flush')
+
+    def _log(self, rec):
+        if self.durability == 'lazy' or self._journal is None: return
+        with metrics.timer('storage_seconds', op='users_journal'):
+            self._write_journal(rec)
+
+    def _write_journal(self, rec):
+        self._journal.write(json.dumps(rec, ensure_ascii=False).encode('utf-8') + b'\n')
+        self._journal.flush()
+        if self.durability == 'fsync':
+            os.fsync(self._journal.fileno())
+        self.journal_records += 1
+
+    def _account(self, key, old, new):
+        if old is None:
+            self.counts['total'] += 1
+        self.counts['trial_left'] += (int(new.get('trial_left') or 0) > 0) - (int((old or {}).get('trial_left') or 0) > 0)
+        ou, nu = int((old or {}).get('premium_until') or 0), int(new.get('premium_until') or 0)
+        if ou != nu:
+            if ou:
+                i = bisect.bisect_left(self.premium_index, (ou, key))
+                if i < len(self.premium_index) and self.premium_index[i] == (ou, key):
+                    del self.premium_index[i]
+            if nu:
+                bisect.insort(self.premium_index, (nu, key))
+
+    def _put(self, key, u):
+        if key not in self.users:
+            self.order.append(key)
+        self._account(key, self.users.get(key), u)
+        self.users[key] = u
+        self.dirty.add(key)
+        self._log({'id': key, 'user': u})
+
+    def get(self, tid):
+        u = self.users.get(str(tid))
+        return dict(u) if u is not None else None
+
+    def __contains__(self, tid):
+        return str(tid) in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def items(self):
+        with self.lock:
+            return list(self.users.items())
+
+    def head(self, n):
+        with self.lock:
+            return list(itertools.islice(self.users.items(), n))
+
+    def page_ids(self, cursor=0, limit=500):
+        # ids in insertion order, which is stable since users are never removed; the cursor is a position
+        with self.lock:
+            ids = self.order[cursor:cursor + limit]
+        return ids, cursor + len(ids)
+
+    def bump(self, name, n=1):
+        # counts a request for feature `name`; the journal gets the new value, so replay is idempotent
+        with self.lock:
+            v = self.counts['requests'][name] = self.counts['requests'].get(name, 0) + n
+            self.requests_dirty = True
+            self._log({'counter': name, 'value': v})
+
+    def requests(self):
+        with self.lock:
+            return dict(self.counts['requests'])
+
+    def premium_active(self, now=None):
+        now = int(time.time()) if now is None else now
+        with self.lock:
+            return len(self.premium_index) - bisect.bisect_right(self.premium_index, (now, '\uffff'))
+
+    def stats(self):
+        with self.lock:
+            return {'total_users': self.counts['total'], 'premium_active': self.premium_active(),
+                    'trial_left': self.counts['trial_left']}
+
+    def next_expiry(self):
+        with self.lock:
+            return self.premium_index[0][0] if self.premium_index else None
+
+    def expire_due(self, now, limit):
+        # revokes up to `limit` premiums whose deadline has passed; returns the ids that lost premium,
+        # which are marked renew_pending until their renewal reminder is sent
+        done, n = [], 0
+        with self.lock:
+            while self.premium_index and self.premium_index[0][0] <= now and n < limit:
+                until, key = self.premium_index[0]
+                u = dict(self.users[key], premium=False, premium_until=0, premium_expired=until)
+                if self.users[key].get('premium'):
+                    done.append(key)
+                    u['renew_pending'] = True
+                self._put(key, u)  # drops the index entry
+                n += 1
+        return done
+
+    def renew_pending(self):
+        with self.lock:
+            return [k for k, u in self.users.items() if u.get('renew_pending')]
+
+    def update(self, tid, info):
+        key = str(tid)
+        with self.lock:
+            u = dict(self.users.get(key, {}))
+            u.update(info)
+            self._put(key, u)
+            return dict(u)
+
+    def setdefault(self, tid, info):
+        key = str(tid)
+        with self.lock:
+            if key not in self.users:
+                return self.update(key, info), True
+            return dict(self.users[key]), False
+
+    def mutate(self, tid, fn):
+        # atomic read-modify-write: fn gets a copy of the record (defaults if missing), may change
+        # it and returns a result; the record is saved only if fn changed it
+        key = str(tid)
+        with self.lock:
+            cur = self.users.get(key)
+            u = dict(cur) if cur is not None else new_user()
+            result = fn(u)
+            if u != cur:
+                self._put(key, u)
+            return result, dict(u)
+
+    def flush(self):
+        with metrics.timer('storage_seconds', op='users_flush'):
+            return self._flush()
+
+    def snapshot_due(self):
+        if self.durability == 'lazy':
+            return bool(self.dirty or self.requests_dirty)
+        return self.journal_records >= max(self.MIN_SNAPSHOT_RECORDS, len(self.users) * self.snapshot_ratio)
+
+    def _flush(self):
+        # the journal already holds every change, so most flushes have nothing to write
+        with self.lock:
+            if not self.snapshot_due(): return 0
+            keys, snap = set(self.dirty), dict(self.users)
+            requests = dict(self.counts['requests'])
+            self.dirty.clear()
+            self.requests_dirty = False
+            mark = self._journal.tell() if self._journal else 0
+            covered = self.journal_records
+        # serialize outside the lock so handlers are not blocked by a large snapshot
+        try:
+            write_json(self.counters_path, {'requests': requests}, indent=None, fsync=self.durability != 'lazy')
+            write_json(self.path, snap, indent=None, fsync=self.durability != 'lazy')
+        except Exception:
+            with self.lock:
+                self.dirty |= keys
+                self.requests_dirty = True
+            raise
+        with self.lock:
+            # drop journal records covered by the (now durable) snapshot: the records written
+            # meanwhile go to a new segment that replaces the journal by rename, so a crash at
+            # any point leaves either the old journal (replaying it again is harmless) or the new one
+            if self._journal:
+                self._journal.flush()
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(mark); tail = f.read()
+                tmp = self.journal_path + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(tail)
+                    if self.durability == 'fsync':
+                        f.flush(); os.fsync(f.fileno())
+                self._journal.close()
+                os.replace(tmp, self.journal_path)
+                if self.durability == 'fsync': fsync_dir(self.journal_path)
+                self._journal = open(self.journal_path, 'ab')
+                self.journal_records -= covered
+        return len(keys)
+
+    def close(self):
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception:
+            logging.exception('users flush on close')
+
+# --- Order journal ---
+class OrderJournal:
+    # Orders are an append-only JSONL log where each line is the full state of one order and
+    # the last line for an id wins. Indexes by id, telegram_id and status are built on load.
+    def __init__(self, path, legacy_path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.orders = {}     # id -> order
+        self.seq = []        # ids in creation order
+        self.by_user = {}    # telegram_id -> [ids]
+        self.by_status = {}  # status -> {id: None}, insertion ordered
+        self.records = 0     # lines in the file, live and superseded
+        self.version = f'{time.time_ns():x}.0'  # changes on every append, for HTTP ETags
+        self._f = None
+        self.load(legacy_path)
+
+    def _index(self, o):
+        oid = o['id']
+        old = self.orders.get(oid)
+        if old is None:
+            self.seq.append(oid)
+            self.by_user.setdefault(o.get('telegram_id'), []).append(oid)
+        else:
+            self.by_status.get(old.get('status'), {}).pop(oid, None)
+        self.orders[oid] = o
+        self.by_status.setdefault(o.get('status'), {})[oid] = None
+
+    def load(self, legacy_path=None):
+        with self.lock:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    for line in f:
+                        try:
+                            o = json.loads(line)
+                        except ValueError:
+                            break  # torn write at the tail after a crash
+                        self._index(o)
+                        self.records += 1
+            elif legacy_path and os.path.exists(legacy_path):
+                for o in read_json(legacy_path) or []:
+                    if o.get('id') is not None: self._index(o)
+                self.records = len(self.orders) + 1  # force a compaction that writes them out
+                logging.info('orders: imported %s orders from %s', len(self.orders), legacy_path)
+            if self.records > len(self.orders) * ORDERS_COMPACT_RATIO or not os.path.exists(self.path):
+                self.compact()
+            else:
+                self._f = open(self.path, 'ab')
+
+    def compact(self):
+        with self.lock:
+            if self._f: self._f.close()
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                for oid in self.seq:
+                    f.write(json.dumps(self.orders[oid], ensure_ascii=False).encode('utf-8') + b'\n')
+                f.flush(); os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.records = len(self.seq)
+            self._f = open(self.path, 'ab')
+
+    def _append(self, o):
+        with metrics.timer('storage_seconds', op='orders_append'):
+            self._write(o)
+        self._index(o)
 
-# Initialize files if missing
-if not os.path.exists(USERS_FILE):
-    write_json(USERS_FILE, {})
-if not os.path.exists(ORDERS_FILE):
-    write_json(ORDERS_FILE, [])
+    def _write(self, o):
+        self._f.write(json.dumps(o, ensure_ascii=False).encode('utf-8') + b'\n')
+        self._f.flush(); os.fsync(self._f.fileno())
+        self.records += 1
+        self.version = f"{self.version.split('.')[0]}.{self.records}"
+
+    def add(self, order):
+        with self.lock:
+            self._append(dict(order))
+            return dict(order)
+
+    def set_status(self, order_id, status):
+        with self.lock:
+            o = self.orders.get(order_id)
+            if o is None or o.get('status') == status: return o
+            o = dict(o, status=status, updated=int(time.time()))
+            self._append(o)
+            return o
+
+    def with_status(self, status):
+        with self.lock:
+            return [self.orders[oid] for oid in self.by_status.get(status, {})]
+
+    def for_user(self, tid, status=None):
+        with self.lock:
+            found = [self.orders[oid] for oid in self.by_user.get(str(tid), [])]
+        return [o for o in found if status is None or o.get('status') == status]
+
+    def last(self, n):
+        with self.lock:
+            return [self.orders[oid] for oid in reversed(self.seq[-n:])] if n > 0 else []
+
+    def page(self, cursor=None, limit=50):
+        # newest first; the cursor is the creation index to continue below
+        with self.lock:
+            end = len(self.seq) if cursor is None else max(0, min(int(cursor), len(self.seq)))
+            start = max(0, end - limit)
+            items = [self.orders[oid] for oid in reversed(self.seq[start:end])]
+        return items, (start if start > 0 else None)
+
+# --- SQLite state backend ---
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    premium INTEGER NOT NULL DEFAULT 0,
+    premium_until INTEGER NOT NULL DEFAULT 0,
+    trial_left INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_premium_until ON users(premium_until);
+CREATE INDEX IF NOT EXISTS users_trial_left ON users(trial_left);
+CREATE INDEX IF NOT EXISTS users_renew_pending ON users(id) WHERE json_extract(data, '$.renew_pending');
+CREATE TABLE IF NOT EXISTS orders (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    telegram_id TEXT,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_user_status ON orders(telegram_id, status);
+CREATE INDEX IF NOT EXISTS orders_status ON orders(status, seq);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS broadcasts (id TEXT PRIMARY KEY, started INTEGER NOT NULL, data TEXT NOT NULL);
+'''
+
+class SqlitePool:
+    # A fixed set of connections shared by the threads of one process. A thread keeps the same
+    # connection until its outermost conn()/tx() block exits, so nested tx() calls join one
+    # transaction. Blocks run synchronously: never await inside them.
+    def __init__(self, path, size=4, busy_timeout=0.1, durability='journal', busy_retries=3):
+        self.path, self.busy_timeout, self.busy_retries = path, busy_timeout, busy_retries
+        self.synchronous = 'FULL' if durability == 'fsync' else 'NORMAL'
+        self.local = threading.local()
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(self._connect())
+        with self.conn() as db:
+            db.executescript(SQLITE_SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(f'PRAGMA synchronous={self.synchronous}')
+        return db
+
+    @contextlib.contextmanager
+    def conn(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            yield db; return
+        db = self.idle.get()
+        self.local.db = db
+        try:
+            yield db
+        finally:
+            self.local.db = None
+            self.idle.put(db)
+
+    def _begin(self, db):
+        # short waits with jitter instead of one long busy timeout: the caller is usually the
+        # event loop, which must not stall for long behind another process's writer
+        for attempt in range(self.busy_retries + 1):
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e) or attempt == self.busy_retries: raise
+                metrics.inc('sqlite_busy_retries')
+                time.sleep(random.uniform(0.005, 0.02))
+
+    @contextlib.contextmanager
+    def tx(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so a read-modify-write cannot be
+        # interleaved with another process's and never fails with SQLITE_BUSY halfway
+        with self.conn() as db:
+            if db.in_transaction:
+                yield db; return
+            with metrics.timer('storage_seconds', op='sqlite_lock_wait'):
+                self._begin(db)
+            try:
+                yield db
+            except BaseException:
+                db.rollback()
+                raise
+            with metrics.timer('storage_seconds', op='sqlite_commit'):
+                db.commit()
+
+class SqliteUserStore:
+    # UserStore's interface on the shared database. The record is kept as JSON, with the fields
+    # that stats and premium expiry query copied into indexed columns.
+    COUNTERS = ('users_total', 'users_trial_left', 'users_premium_until')
+
+    def __init__(self, pool):
+        self.pool = pool
+        with pool.tx() as db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'users_total'").fetchone() is None:
+                # a database from before the counters: count once
+                total, trial, until = db.execute(
+                    'SELECT COUNT(*), COUNT(*) FILTER (WHERE trial_left > 0), COUNT(*) FILTER (WHERE premium_until > 0) FROM users').fetchone()
+                for name, v in zip(self.COUNTERS, (total, trial, until)):
+                    db.execute('INSERT INTO meta (key, value) VALUES (?, ?)', (name, v))
+
+    @staticmethod
+    def _bump(db, name, delta):
+        if delta:
+            db.execute('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value', (name, delta))
+
+    def _put(self, db, key, u, old):
+        # `old` is the stored record (None if new); counters change in the same transaction
+        self._bump(db, 'users_total', old is None)
+        self._bump(db, 'users_trial_left', (int(u.get('trial_left') or 0) > 0) - (int((old or {}).get('trial_left') or 0) > 0))
+        self._bump(db, 'users_premium_until', (int(u.get('premium_until') or 0) > 0) - (int((old or {}).get('premium_until') or 0) > 0))
+        db.execute('INSERT INTO users (id, data, premium, premium_until, trial_left) VALUES (?, ?, ?, ?, ?) '
+                   'ON CONFLICT(id) DO UPDATE SET data=excluded.data, premium=excluded.premium, '
+                   'premium_until=excluded.premium_until, trial_left=excluded.trial_left',
+                   (key, json.dumps(u, ensure_ascii=False), int(bool(u.get('premium'))),
+                    int(u.get('premium_until') or 0), int(u.get('trial_left') or 0)))
+
+    def _get(self, db, key):
+        r = db.execute('SELECT data FROM users WHERE id = ?', (key,)).fetchone()
+        return json.loads(r[0]) if r else None
+
+    def start(self):
+        pass
+
+    def flush(self):
+        return 0  # every change is committed as it happens
+
+    def close(self):
+        pass
+
+    def get(self, tid):
+        with self.pool.conn() as db:
+            return self._get(db, str(tid))
+
+    def __contains__(self, tid):
+        with self.pool.conn() as db:
+            return db.execute('SELECT 1 FROM users WHERE id = ?', (str(tid),)).fetchone() is not None
+
+    def __len__(self):
+        with self.pool.conn() as db:
+            r = db.execute("SELECT CAST(value AS INTEGER) FROM meta WHERE key = 'users_total'").fetchone()
+        return r[0] if r else 0
+
+    def items(self):
+        with self.pool.conn() as db:
+            return [(k, json.loads(d)) for k, d in db.execute('SELECT id, data FROM users ORDER BY rowid')]
+
+    def head(self, n):
+        with self.pool.conn() as db:
+            return [(k, json.loads(d)) for k, d in db.execute('SELECT id, data FROM users ORDER BY rowid LIMIT ?', (n,))]
+
+    def page_ids(self, cursor=0, limit=500):
+        # the cursor is the last rowid returned
+        with self.pool.conn() as db:
+            rows = db.execute('SELECT rowid, id FROM users WHERE rowid > ? ORDER BY rowid LIMIT ?', (cursor, limit)).fetchall()
+        return [k for _, k in rows], (rows[-1][0] if rows else cursor)
+
+    def bump(self, name, n=1):
+        with self.pool.tx() as db:
+            self._bump(db, 'requests:' + name, n)
+
+    def requests(self):
+        with self.pool.conn() as db:
+            return {k[9:]: v for k, v in db.execute("SELECT key, CAST(value AS INTEGER) FROM meta WHERE key LIKE 'requests:%'")}
+
+    def premium_active(self, now=None):
+        now = int(time.time()) if now is None else now
+        with self.pool.conn() as db:
+            return db.execute('SELECT COUNT(*) FROM users WHERE premium_until > ?', (now,)).fetchone()[0]
+
+    def stats(self):
+        # counters from meta; premium_active subtracts the deadlines already passed but not yet
+        # revoked, an index range the expiry scheduler keeps near empty
+        with self.pool.conn() as db:
+            c = dict(db.execute('SELECT key, CAST(value AS INTEGER) FROM meta WHERE key IN (?, ?, ?)', self.COUNTERS))
+            due = db.execute('SELECT COUNT(*) FROM users WHERE premium_until > 0 AND premium_until <= ?', (int(time.time()),)).fetchone()[0]
+        return {'total_users': c.get('users_total', 0), 'premium_active': c.get('users_premium_until', 0) - due,
+                'trial_left': c.get('users_trial_left', 0)}
+
+    def next_expiry(self):
+        with self.pool.conn() as db:
+            r = db.execute('SELECT premium_until FROM users WHERE premium_until > 0 ORDER BY premium_until LIMIT 1').fetchone()
+        return r[0] if r else None
+
+    def expire_due(self, now, limit):
+        # one transaction, so when several processes run the scheduler each premium is revoked
+        # (and its owner reminded) exactly once
+        done = []
+        with self.pool.tx() as db:
+            rows = db.execute('SELECT id, data FROM users WHERE premium_until > 0 AND premium_until <= ? '
+                              'ORDER BY premium_until LIMIT ?', (now, limit)).fetchall()
+            for key, data in rows:
+                old = json.loads(data)
+                u = dict(old, premium=False, premium_until=0, premium_expired=int(old.get('premium_until') or 0))
+                if old.get('premium'):
+                    done.append(key)
+                    u['renew_pending'] = True
+                self._put(db, key, u, old)
+        return done
+
+    def renew_pending(self):
+        with self.pool.conn() as db:
+            return [k for k, in db.execute("SELECT id FROM users WHERE json_extract(data, '$.renew_pending')")]
+
+    def update(self, tid, info):
+        key = str(tid)
+        with self.pool.tx() as db:
+            old = self._get(db, key)
+            u = dict(old or {})
+            u.update(info)
+            self._put(db, key, u, old)
+            return u
+
+    def setdefault(self, tid, info):
+        key = str(tid)
+        with self.pool.tx() as db:
+            u = self._get(db, key)
+            if u is not None:
+                return u, False
+            self._put(db, key, dict(info), None)
+            return dict(info), True
+
+    def mutate(self, tid, fn):
+        key = str(tid)
+        with self.pool.tx() as db:
+            cur = self._get(db, key)
+            u = dict(cur) if cur is not None else new_user()
+            result = fn(u)
+            if u != cur:
+                self._put(db, key, u, cur)
+            return result, dict(u)
+
+class SqliteOrderStore:
+    # OrderJournal's interface on the shared database; seq keeps creation order and is the page
+    # cursor, and the meta row orders_rev changes on every write (the HTTP ETag)
+    def __init__(self, pool):
+        self.pool = pool
+
+    @property
+    def version(self):
+        with self.pool.conn() as db:
+            r = db.execute("SELECT value FROM meta WHERE key = 'orders_rev'").fetchone()
+        return f'sqlite.{r[0] if r else 0}'
+
+    @property
+    def records(self):
+        with self.pool.conn() as db:
+            return db.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+
+    def _append(self, db, o):
+        with metrics.timer('storage_seconds', op='orders_append'):
+            db.execute('INSERT INTO orders (id, telegram_id, status, data) VALUES (?, ?, ?, ?) '
+                       'ON CONFLICT(id) DO UPDATE SET telegram_id=excluded.telegram_id, status=excluded.status, data=excluded.data',
+                       (o['id'], o.get('telegram_id'), o.get('status'), json.dumps(o, ensure_ascii=False)))
+            db.execute("INSERT INTO meta (key, value) VALUES ('orders_rev', 1) "
+                       "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+
+    def _select(self, sql, args=()):
+        with self.pool.conn() as db:
+            return [json.loads(d) for d, in db.execute(sql, args)]
+
+    def compact(self):
+        # nothing to compact; fold the WAL back into the database file
+        with self.pool.conn() as db:
+            db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def add(self, order):
+        with self.pool.tx() as db:
+            self._append(db, order)
+        return dict(order)
+
+    def set_status(self, order_id, status):
+        with self.pool.tx() as db:
+            r = db.execute('SELECT data FROM orders WHERE id = ?', (order_id,)).fetchone()
+            o = json.loads(r[0]) if r else None
+            if o is None or o.get('status') == status: return o
+            o = dict(o, status=status, updated=int(time.time()))
+            self._append(db, o)
+            return o
+
+    def with_status(self, status):
+        return self._select('SELECT data FROM orders WHERE status = ? ORDER BY seq', (status,))
+
+    def for_user(self, tid, status=None):
+        if status is None:
+            return self._select('SELECT data FROM orders WHERE telegram_id = ? ORDER BY seq', (str(tid),))
+        return self._select('SELECT data FROM orders WHERE telegram_id = ? AND status = ? ORDER BY seq', (str(tid), status))
+
+    def last(self, n):
+        return self._select('SELECT data FROM orders ORDER BY seq DESC LIMIT ?', (n,)) if n > 0 else []
+
+    def page(self, cursor=None, limit=50):
+        # newest first; the cursor is the seq to continue below
+        with self.pool.conn() as db:
+            rows = db.execute('SELECT seq, data FROM orders WHERE seq < ? ORDER BY seq DESC LIMIT ?',
+                              (int(cursor) if cursor is not None else 2**62, limit + 1)).fetchall()
+        items = [json.loads(d) for _, d in rows[:limit]]
+        return items, (rows[limit - 1][0] if len(rows) > limit else None)
+
+def migrate_to_sqlite(pool, force=False):
+    # one-shot import of users.json (plus its journal) and orders.jsonl (or the legacy orders.json);
+    # returns None if the database was already migrated and force is not set
+    with pool.conn() as db:
+        if db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone() and not force:
+            return None
+    users = UserStore(USERS_FILE, USERS_JOURNAL, durability='lazy')
+    orders = OrderJournal(ORDERS_JOURNAL, legacy_path=ORDERS_FILE)
+    su, so = SqliteUserStore(pool), SqliteOrderStore(pool)
+    with pool.tx() as db:
+        for key, u in users.items():
+            su._put(db, key, u, su._get(db, key))
+        for name, v in users.requests().items():
+            db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('requests:' + name, v))
+        for o in reversed(orders.last(len(orders.seq))):
+            so._append(db, o)
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)", (str(int(time.time())),))
+    return len(users), len(orders.seq)
+
+if __name__ == '__main__' and sys.argv[1:2] == ['migrate-sqlite']:
+    res = migrate_to_sqlite(SqlitePool(STATE_DB), force='--force' in sys.argv)
+    if res is None:
+        print(f'{STATE_DB} is already migrated; pass --force to import the JSON files again')
+    else:
+        print(f'migrated {res[0]} users and {res[1]} orders to {STATE_DB}')
+    raise SystemExit(0)
+
+if STATE_BACKEND == 'sqlite':
+    state_db = SqlitePool(STATE_DB, SQLITE_POOL_SIZE, SQLITE_BUSY_TIMEOUT, USERS_DURABILITY, SQLITE_BUSY_RETRIES)
+    users_store = SqliteUserStore(state_db)
+    orders_journal = SqliteOrderStore(state_db)
+else:
+    users_store = UserStore(USERS_FILE, USERS_JOURNAL, USERS_FLUSH_INTERVAL, USERS_DURABILITY, USERS_SNAPSHOT_RATIO)
+    users_store.start()
+    atexit.register(users_store.close)
+    orders_journal = OrderJournal(ORDERS_JOURNAL, legacy_path=ORDERS_FILE)
+
+@contextlib.contextmanager
+def state_transaction():
+    # groups user and order changes: one SQLite transaction, or both store locks with the JSON files
+    if STATE_BACKEND == 'sqlite':
+        with state_db.tx():
+            yield
+    else:
+        with users_store.lock, orders_journal.lock:
+            yield
+
+if __name__ == '__main__' and sys.argv[1:2] == ['compact-orders']:
+    orders_journal.compact()
+    print(f'orders compacted: {orders_journal.records} records')
+    raise SystemExit(0)
 
 # --- Bot init ---
 if not TELEGRAM_TOKEN:
@@ -72,278 +1180,790 @@ dp = Dispatcher()
 
 # --- Utilities ---
 def get_user(tid):
-    users = read_json(USERS_FILE)
-    return users.get(str(tid), {"trial_left":2, "premium": False, "premium_until":0, "lang": DEFAULT_LANG, "requests": 0})
+    return users_store.get(tid) or new_user()
 
 def save_user(tid, info):
-    users = read_json(USERS_FILE)
-    users = users or {}
-    users[str(tid)] = users.get(str(tid), {})
-    users[str(tid)].update(info)
-    write_json(USERS_FILE, users)
+    return users_store.update(tid, info)
 
 def check_premium(tid):
-    u = get_user(tid)
-    until = u.get('premium_until', 0)
-    if until and int(time.time()) < int(until):
-        return True
-    return u.get('premium', False)
+    # the flag is authoritative: expiry_scheduler clears it when premium_until passes
+    return bool(get_user(tid).get('premium', False))
 
 def grant_premium(tid, days=30):
-    u = get_user(tid)
-    u['premium'] = True
-    u['premium_until'] = int(time.time()) + days*24*3600
-    save_user(tid, u)
-    action_logger.info(f"grant_premium {tid} days={days} by_admin")
+    until = int(time.time()) + days*24*3600
+    users_store.mutate(tid, lambda u: u.update(premium=True, premium_until=until))
+    expiry_scheduler.notify()
+    log_action('grant_premium', tid, days=days, by='admin')
 
 def revoke_premium(tid):
-    u = get_user(tid)
-    u['premium'] = False
-    u['premium_until'] = 0
-    save_user(tid, u)
-    action_logger.info(f"revoke_premium {tid} by_admin")
+    users_store.mutate(tid, lambda u: u.update(premium=False, premium_until=0))
+    log_action('revoke_premium', tid, by='admin')
 
 def add_order_manual(tid):
-    orders = read_json(ORDERS_FILE) or []
-    entry = {"id": f"man_{int(time.time())}", "telegram_id": str(tid), "timestamp": int(time.time()), "status": "pending"}
-    orders.append(entry)
-    write_json(ORDERS_FILE, orders)
-    action_logger.info(f"manual_order {tid}")
+    now = int(time.time())
+    entry = orders_journal.add({"id": f"man_{now}_{tid}", "telegram_id": str(tid), "timestamp": now, "status": "pending"})
+    log_action('manual_order', tid, order=entry['id'])
     return entry
 
 def list_pending_orders():
-    orders = read_json(ORDERS_FILE) or []
-    return [o for o in orders if o.get('status')=='pending']
+    return orders_journal.with_status('pending')
 
 def update_order_status(order_id, status):
-    orders = read_json(ORDERS_FILE) or []
-    for o in orders:
-        if o.get('id') == order_id:
-            o['status'] = status
-    write_json(ORDERS_FILE, orders)
-
-def hf_request(prompt):
-    HF = os.getenv('HF_API_URL','https://api-inference.huggingface.co/models/Qwen/Qwen2.5-7B-Instruct')
-    KEY = os.getenv('HF_API_KEY')
-    if not KEY: return "AI not configured. Ask admin to set HF_API_KEY."
+    return orders_journal.set_status(order_id, status)
+
+def close_user_orders(tid, status):
+    # settle every pending order of a user, e.g. after the admin approved or rejected a payment
+    with state_transaction():
+        return [update_order_status(o['id'], status) for o in orders_journal.for_user(tid, 'pending')]
+
+# --- Rate limiting ---
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.ts = burst, time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def try_acquire(self, n=1):
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    async def acquire(self, n=1):
+        while not self.try_acquire(n):
+            await asyncio.sleep((n - self.tokens) / self.rate)
+
+# --- AI client ---
+class AIBusy(Exception):
+    pass
+
+class AIStreamUnavailable(Exception):
+    def __init__(self, status, text):
+        super().__init__(f'HTTP {status}: {text}')
+        self.status, self.text = status, text
+
+    @property
+    def overloaded(self):
+        # rate limited or failing server side: sending the same prompt again only adds load
+        return self.status == 429 or self.status >= 500
+
+class AIClient:
+    # One keep-alive connection pool shared by all handlers. At most `concurrency` requests are
+    # in flight, up to `queue_limit` more wait for a slot and anything beyond that is shed.
+    def __init__(self, url, key, concurrency=8, queue_limit=100, deadline=25, retries=3, backoff_max=8, stream_cooldown=600):
+        self.url, self.key = url, key
+        self.concurrency, self.queue_limit = concurrency, queue_limit
+        self.deadline, self.retries, self.backoff_max = deadline, retries, backoff_max
+        self.stream_cooldown = stream_cooldown
+        self.streaming_off_until = 0.0  # loop time; set when the endpoint does not stream
+        self.waiting = 0
+        self._sem = asyncio.Semaphore(concurrency)
+        self._session = None
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60),
+                headers={'Authorization': f'Bearer {self.key}'})
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self.waiting >= self.queue_limit:
+            raise AIBusy()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.deadline)
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self._sem.release()
+
+    async def post(self, payload):
+        # returns (HTTP status, json)
+        deadline = asyncio.get_running_loop().time() + self.deadline
+        async with self.slot():
+            return await self._post(payload, deadline)
+
+    def streaming(self):
+        return asyncio.get_running_loop().time() >= self.streaming_off_until
+
+    def _streaming_off(self, why):
+        logging.warning('AI endpoint does not stream (%s), streaming paused for %ss', why, self.stream_cooldown)
+        self.streaming_off_until = asyncio.get_running_loop().time() + self.stream_cooldown
+
+    async def stream(self, payload):
+        # yields text chunks from a TGI-style server-sent event stream; a plain JSON answer is
+        # yielded whole, anything else (e.g. 503 while the model loads) raises AIStreamUnavailable.
+        # An endpoint that refuses stream=True (4xx) or answers with plain JSON pauses streaming
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        async with self.slot():
+            timeout = aiohttp.ClientTimeout(total=max(deadline - loop.time(), 0.1))
+            async with self.session().post(self.url, json=dict(payload, stream=True), timeout=timeout) as r:
+                if r.status != 200:
+                    try:
+                        j = await r.json(content_type=None)
+                    except ValueError:
+                        j = None
+                    e = AIStreamUnavailable(r.status, _error_text(r.status, j))
+                    if not e.overloaded: self._streaming_off(f'HTTP {r.status}')
+                    raise e
+                if r.content_type != 'text/event-stream':
+                    self._streaming_off(r.content_type)
+                    j = await r.json(content_type=None)
+                    text, ok = _parse_generation(j)
+                    if not ok: raise AIStreamUnavailable(r.status, _error_text(r.status, j))
+                    yield text
+                    return
+                async for line in r.content:
+                    line = line.strip()
+                    if not line.startswith(b'data:'): continue
+                    ev = json.loads(line[5:])
+                    if ev.get('error'): raise RuntimeError(ev['error'])
+                    tok = ev.get('token') or {}
+                    if tok.get('text') and not tok.get('special'):
+                        yield tok['text']
+
+    async def _post(self, payload, deadline):
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            left = deadline - loop.time()
+            if left <= 0:
+                raise asyncio.TimeoutError()
+            t0 = time.perf_counter()
+            async with self.session().post(self.url, json=payload, timeout=aiohttp.ClientTimeout(total=left)) as r:
+                j = await r.json(content_type=None)
+                metrics.observe('ai_http_seconds', time.perf_counter() - t0, status=r.status)
+                if r.status != 503 or attempt >= self.retries:
+                    return r.status, j
+            # model is loading: wait for HF's estimate, at least an exponential backoff step
+            est = j.get('estimated_time', 0) if isinstance(j, dict) else 0
+            delay = min(self.backoff_max, max(float(est or 0), 2 ** attempt)) * random.uniform(0.8, 1.2)
+            if loop.time() + delay >= deadline:
+                raise asyncio.TimeoutError()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+ai_client = AIClient(HF_API_URL, HF_API_KEY, AI_CONCURRENCY, AI_QUEUE_LIMIT, AI_DEADLINE, AI_RETRIES, AI_BACKOFF_MAX, AI_STREAM_COOLDOWN)
+dp.shutdown.register(ai_client.close)
+
+def _parse_generation(j):
+    if isinstance(j, list) and j and isinstance(j[0], dict) and 'generated_text' in j[0]: return j[0]['generated_text'], True
+    if isinstance(j, dict) and 'generated_text' in j: return j['generated_text'], True
+    return str(j), False
+
+def _error_text(status, j):
+    err = j.get('error') if isinstance(j, dict) else None
+    return f"AI error: {err or f'HTTP {status}'}"
+
+async def _hf_post(inputs):
+    # returns (status, json, error text); error texts are meant for the user and must not be cached.
+    # Non-200 answers (429 rate limit, 5xx, 503 after the retries) come back as error texts too,
+    # only with the status kept so batching can tell "list inputs not supported" apart
+    try:
+        status, j = await ai_client.post({'inputs':inputs,'parameters':{'max_new_tokens':300}})
+    except AIBusy:
+        logging.warning('hf_post shed: %s waiting', ai_client.waiting)
+        return None, None, "AI is busy right now, please try again in a minute."
+    except asyncio.TimeoutError:
+        logging.warning('hf_post deadline exceeded')
+        return None, None, "AI error: timed out"
+    except Exception as e:
+        logging.exception('hf_post')
+        return None, None, f"AI error: {e}"
+    if status != 200 or (isinstance(j, dict) and j.get('error')):
+        logging.warning('hf_post HTTP %s: %s', status, str(j)[:200])
+        return status, j, _error_text(status, j)
+    return status, j, None
+
+async def hf_generate(prompt):
+    # returns (text, ok)
+    if not HF_API_KEY: return "AI not configured. Ask admin to set HF_API_KEY.", False
+    _, j, err = await _hf_post(prompt)
+    return (err, False) if err else _parse_generation(j)
+
+async def hf_generate_batch(prompts):
+    # returns [(text, ok)] aligned with prompts, or None if the endpoint does not take list inputs
+    # (a 400/422, or a 200 that is not one answer per input); other errors fail the whole batch
+    if not HF_API_KEY: return [("AI not configured. Ask admin to set HF_API_KEY.", False)] * len(prompts)
+    status, j, err = await _hf_post(prompts)
+    if status in (400, 422): return None
+    if err: return [(err, False)] * len(prompts)
+    if not isinstance(j, list) or len(j) != len(prompts): return None
+    return [_parse_generation(x) for x in j]
+
+# --- AI batching ---
+class InferenceBatcher:
+    # Sits between the handlers and HF: identical prompts in flight share one future and
+    # distinct ones are collected for a short window and sent as a single batched request.
+    def __init__(self, window, max_batch, cooldown=600):
+        self.window, self.max_batch, self.cooldown = window, max_batch, cooldown
+        self.batching_off_until = 0.0  # loop time; set when the endpoint refuses list inputs
+        self.inflight = {}  # prompt -> future
+        self.pending = []
+        self._timer = None
+        self._tasks = set()
+        self.stats = {'submitted': 0, 'deduped': 0, 'batches': 0, 'batched_prompts': 0, 'fallbacks': 0}
+
+    async def submit(self, prompt):
+        self.stats['submitted'] += 1
+        fut = self.inflight.get(prompt)
+        if fut is not None:
+            self.stats['deduped'] += 1
+            return await asyncio.shield(fut)
+        fut = self.inflight[prompt] = asyncio.get_running_loop().create_future()
+        self.pending.append(prompt)
+        if len(self.pending) >= self.batch_limit():
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._dispatch)
+        return await asyncio.shield(fut)
+
+    def batch_limit(self):
+        return 1 if asyncio.get_running_loop().time() < self.batching_off_until else self.max_batch
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel(); self._timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            t = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(t); t.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        try:
+            results = None
+            if len(batch) > 1:
+                results = await hf_generate_batch(batch)
+                if results is None:
+                    # the endpoint does not take a list of inputs: go one by one for a while
+                    logging.warning('AI endpoint rejected a batch of %s, batching paused for %ss', len(batch), self.cooldown)
+                    self.batching_off_until = asyncio.get_running_loop().time() + self.cooldown
+                    self.stats['fallbacks'] += 1
+                else:
+                    self.stats['batches'] += 1
+                    self.stats['batched_prompts'] += len(batch)
+            if results is None:
+                results = await asyncio.gather(*(hf_generate(p) for p in batch))
+        except Exception as e:
+            logging.exception('batch generation')
+            results = [(f"AI error: {e}", False)] * len(batch)
+        for p, r in zip(batch, results):
+            fut = self.inflight.pop(p, None)
+            if fut is not None and not fut.done(): fut.set_result(r)
+
+ai_batcher = InferenceBatcher(AI_BATCH_WINDOW_MS / 1000, AI_BATCH_MAX, AI_BATCH_COOLDOWN)
+
+# --- AI response cache ---
+class ResponseCache:
+    # LRU in memory in front of an optional size-bounded directory of JSON files.
+    # The disk tier is touched from a worker thread, hence the lock.
+    def __init__(self, max_entries, disk_dir=None, disk_max_bytes=0):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self.mem = OrderedDict()  # key -> (expires, text)
+        self.lock = threading.Lock()
+        self.stats = {'hits_mem': 0, 'hits_disk': 0, 'misses': 0, 'stores': 0, 'evictions_mem': 0, 'evictions_disk': 0}
+        self.disk_bytes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.disk_bytes = sum(e.stat().st_size for e in os.scandir(self.disk_dir) if e.name.endswith('.json'))
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            e = self.mem.get(key)
+            if e is not None:
+                if e[0] > time.time():
+                    self.mem.move_to_end(key)
+                    self.stats['hits_mem'] += 1
+                    return e[1]
+                del self.mem[key]
+            if not self.disk_dir:
+                self.stats['misses'] += 1
+        return None
+
+    def get_disk(self, key):
+        path = os.path.join(self.disk_dir, key + '.json')
+        with metrics.timer('storage_seconds', op='ai_cache_read'):
+            e = read_json(path) if os.path.exists(path) else None
+        with self.lock:
+            if e and e.get('expires', 0) > time.time():
+                self.stats['hits_disk'] += 1
+                self._put_mem(key, e['expires'], e['text'])
+                return e['text']
+            self.stats['misses'] += 1
+        return None
+
+    def _put_mem(self, key, expires, text):
+        self.mem[key] = (expires, text)
+        self.mem.move_to_end(key)
+        while len(self.mem) > self.max_entries:
+            self.mem.popitem(last=False)
+            self.stats['evictions_mem'] += 1
+
+    def put(self, key, text, ttl):
+        with self.lock:
+            self._put_mem(key, time.time() + ttl, text)
+            self.stats['stores'] += 1
+
+    def put_disk(self, key, text, ttl):
+        path = os.path.join(self.disk_dir, key + '.json')
+        with metrics.timer('storage_seconds', op='ai_cache_write'):
+            expires = time.time() + ttl
+            write_json(path, {'expires': expires, 'text': text}, indent=None)
+            os.utime(path, (expires, expires))  # mtime carries the expiry, so eviction needs no reads
+        with self.lock:
+            self.disk_bytes += os.path.getsize(path)
+            if self.disk_bytes <= self.disk_max_bytes: return
+        # over budget: drop expired files first, then the ones closest to expiry, down to 90% of the limit
+        now, files = time.time(), []
+        for e in os.scandir(self.disk_dir):
+            if e.name.endswith('.json'):
+                st = e.stat()
+                files.append((st.st_mtime, st.st_size, e.path))
+        files.sort()
+        total = sum(f[1] for f in files)
+        for expires, size, p in files:
+            if expires > now and total <= self.disk_max_bytes * 0.9: break
+            try:
+                os.remove(p)
+            except OSError:
+                continue
+            total -= size
+            self.stats['evictions_disk'] += 1
+        with self.lock:
+            self.disk_bytes = total
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.stats['hits_mem'] + self.stats['hits_disk'] + self.stats['misses']
+            hits = self.stats['hits_mem'] + self.stats['hits_disk']
+            return dict(self.stats, entries_mem=len(self.mem), disk_bytes=self.disk_bytes,
+                        hit_ratio=round(hits / lookups, 3) if lookups else 0.0)
+
+ai_cache = ResponseCache(AI_CACHE_SIZE, AI_CACHE_DIR, int(AI_CACHE_DISK_MB * 1024 * 1024))
+
+async def ai_cached(feature, key):
+    if AI_CACHE_TTL.get(feature, 0) <= 0: return None
+    res = ai_cache.get(key)
+    if res is None and ai_cache.disk_dir:
+        res = await asyncio.to_thread(ai_cache.get_disk, key)
+    return res
+
+async def ai_remember(feature, key, text):
+    ttl = AI_CACHE_TTL.get(feature, 0)
+    if ttl <= 0: return
+    ai_cache.put(key, text, ttl)
+    if ai_cache.disk_dir:
+        await asyncio.to_thread(ai_cache.put_disk, key, text, ttl)
+
+async def ai_generate(feature, prompt, name, lang):
+    # one-shot generation through the cache and the batcher; returns (text, 'cache' | 'ok' | 'error')
+    key = ResponseCache.make_key(feature, name, lang, prompt)
+    res = await ai_cached(feature, key)
+    if res is not None:
+        return res, 'cache'
+    res, ok = await ai_batcher.submit(prompt)
+    if ok:
+        await ai_remember(feature, key, res)
+    return res, 'ok' if ok else 'error'
+
+# --- AI streaming replies ---
+def requests_by_feature():
+    # kept by the store, so the counts survive restarts and are shared by all processes
+    return dict({f: 0 for f in AI_CACHE_TTL}, **users_store.requests())
+
+stream_edits = TokenBucket(AI_STREAM_EDITS_PER_SEC, AI_STREAM_EDITS_PER_SEC)
+stream_stats = {'streams': 0, 'fallbacks': 0, 'ttft_sum': 0.0, 'total_sum': 0.0}
+
+async def _edit(msg, text):
+    try:
+        await msg.edit_text(text[:4096])
+    except Exception as e:
+        # "message is not modified" and friends are harmless here
+        logging.debug('stream edit failed: %s', e)
+
+async def ai_reply(message, feature, prompt, name, lang, counted=False):
+    # answers `message` with a generation: cached answers and AI_STREAM=0 go out in one message,
+    # otherwise a placeholder is posted and edited as tokens arrive. The request is counted for
+    # `feature` unless the caller already did (trial use counts it in the same transaction)
+    if not counted:
+        users_store.bump(feature)
+    t0, outcome = time.perf_counter(), 'exception'
+    try:
+        outcome = await _ai_reply(message, feature, prompt, name, lang)
+    finally:
+        metrics.observe('ai_seconds', time.perf_counter() - t0, feature=feature, outcome=outcome)
+
+async def _ai_reply(message, feature, prompt, name, lang):
+    if not AI_STREAM or not HF_API_KEY or not ai_client.streaming():
+        res, outcome = await ai_generate(feature, prompt, name, lang)
+        await message.answer(res)
+        return outcome
+    key = ResponseCache.make_key(feature, name, lang, prompt)
+    res = await ai_cached(feature, key)
+    if res is not None:
+        await message.answer(res)
+        return 'cache'
+    t0 = time.monotonic()
+    msg = await message.answer('⏳')
+    text, shown, ttft, last_edit, ok, outcome = '', '', None, 0.0, True, 'ok'
     try:
-        r = requests.post(HF, headers={'Authorization':f'Bearer {KEY}'}, json={'inputs':prompt,'parameters':{'max_new_tokens':300}}, timeout=25)
-        j = r.json()
-        if isinstance(j, list) and 'generated_text' in j[0]: return j[0]['generated_text']
-        if isinstance(j, dict) and 'generated_text' in j: return j['generated_text']
-        return str(j)
+        async for chunk in ai_client.stream({'inputs':prompt,'parameters':{'max_new_tokens':300}}):
+            now = time.monotonic()
+            if ttft is None: ttft = now - t0
+            text += chunk
+            if now - last_edit >= AI_STREAM_EDIT_INTERVAL and text.strip() and stream_edits.try_acquire():
+                await _edit(msg, text); shown, last_edit = text, now
+    except AIStreamUnavailable as e:
+        if e.overloaded:
+            logging.warning('ai stream %s', e)
+            text, ok, outcome = e.text, False, 'error'
+        else:
+            logging.info('ai stream unavailable (%s), falling back to one-shot', e)
+            stream_stats['fallbacks'] += 1
+            text, outcome = await ai_generate(feature, prompt, name, lang)
+            ok = False  # ai_generate has cached it already
+    except AIBusy:
+        text, ok, outcome = "AI is busy right now, please try again in a minute.", False, 'busy'
+    except asyncio.TimeoutError:
+        text = text + ' …' if text else "AI error: timed out"
+        ok, outcome = False, 'timeout'
     except Exception as e:
-        logging.exception('hf_request')
-        return f"AI error: {e}"
+        logging.exception('ai stream')
+        text, ok, outcome = f"AI error: {e}", False, 'error'
+    total = time.monotonic() - t0
+    if text != shown:
+        await stream_edits.acquire()
+        await _edit(msg, text or '…')
+    if ttft is not None:
+        stream_stats['streams'] += 1
+        stream_stats['ttft_sum'] += ttft
+        stream_stats['total_sum'] += total
+        metrics.observe('ai_ttft_seconds', ttft, feature=feature)
+        logging.info('ai stream %s ttft=%.2fs total=%.2fs', feature, ttft, total)
+    if ok and text:
+        await ai_remember(feature, key, text)
+    return outcome
 
 # --- Keyboards ---
+# Menus depend only on language and role, so they are built once at import and shared by all
+# handlers. Shared markups must never be mutated.
+MAIN_MENU = [('btn_mini','mini'), ('btn_compat','compat'), ('btn_advice','advice'), ('btn_premium','premium'),
+             ('btn_buy','buy'), ('btn_status','status'), ('btn_lang','lang')]
+PREMIUM_MENU = [('btn_deep','deep_portrait'), ('btn_relpro','relationship_pro'), ('btn_partner','partner'), ('btn_back_menu','back')]
+
+def _menu(items, lang, extra=()):
+    rows = [[InlineKeyboardButton(text=tr(k, lang), callback_data=data)] for k, data in items]
+    return InlineKeyboardMarkup(inline_keyboard=rows + list(extra))
+
+MISSING_I18N = validate_i18n()
+ADMIN_ROW = [InlineKeyboardButton(text='🛠 Admin panel', callback_data='admin_panel')]
+MAIN_KB = {(l, admin): _menu(MAIN_MENU, l, [ADMIN_ROW] if admin else []) for l in LANGS for admin in (False, True)}
+PREMIUM_KB = {l: _menu(PREMIUM_MENU, l) for l in LANGS}
+BUY_KB = {l: InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=f"Перевести на карту: {CARD_NUMBER}", callback_data='copy_card')],
+    [InlineKeyboardButton(text="Я оплатил", callback_data='i_paid')],
+    [InlineKeyboardButton(text=tr('btn_back', l), callback_data='back')],
+]) for l in LANGS}
+LANG_KB = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=LANGS[k], callback_data=f"set_lang_{k}") for k in LANGS]])
+ADMIN_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text='📊 Статистика', callback_data='adm_stats'), InlineKeyboardButton(text='👤 Пользователи', callback_data='adm_users')],
+    [InlineKeyboardButton(text='💳 Заявки', callback_data='adm_orders'), InlineKeyboardButton(text='📝 Логи', callback_data='adm_logs')],
+    [InlineKeyboardButton(text='⭐ Управлять Premium', callback_data='adm_manage'), InlineKeyboardButton(text='📣 Рассылка', callback_data='adm_broadcast')],
+    [InlineKeyboardButton(text='⬅️ Назад', callback_data='adm_back')],
+])
+ADMIN_MANAGE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text='Выдать Premium (ID)', callback_data='adm_grant_prompt')],
+    [InlineKeyboardButton(text='Забрать Premium (ID)', callback_data='adm_revoke_prompt')],
+    [InlineKeyboardButton(text='⬅️ Назад', callback_data='adm_back')],
+])
+
+ADMIN_BROADCAST_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text='🔄 Обновить', callback_data='adm_broadcast'), InlineKeyboardButton(text='⏹ Остановить', callback_data='adm_broadcast_stop')],
+    [InlineKeyboardButton(text='⬅️ Назад', callback_data='adm_back')],
+])
+
+ADMIN_LOGS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text='🔄 Обновить', callback_data='adm_logs'), InlineKeyboardButton(text='📄 Файл', callback_data='adm_logs_file')],
+    [InlineKeyboardButton(text='⬅️ Назад', callback_data='adm_back')],
+])
+
 def main_kb(user_id, lang):
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton({'en':'🧠 Mini personality','ru':'🧠 Мини-анализ','kz':'🧠 Мини-талдау'}[lang], callback_data='mini')],
-        [InlineKeyboardButton({'en':'❤️ Compatibility','ru':'❤️ Совместимость','kz':'❤️ Сәйкестік'}[lang], callback_data='compat')],
-        [InlineKeyboardButton({'en':'🔮 AI Advice','ru':'🔮 Совет AI','kz':'🔮 AI кеңес'}[lang], callback_data='advice')],
-        [InlineKeyboardButton({'en':'💎 Premium analysis','ru':'💎 Премиум анализ','kz':'💎 Премиум талдау'}[lang], callback_data='premium')],
-        [InlineKeyboardButton({'en':'💳 Buy Premium','ru':'💳 Купить Premium','kz':'💳 Premium сатып алу'}[lang], callback_data='buy')],
-        [InlineKeyboardButton({'en':'📊 My status','ru':'📊 Мой статус','kz':'📊 Жағдайым'}[lang], callback_data='status')],
-        [InlineKeyboardButton({'en':'🌐 Language','ru':'🌐 Язык','kz':'🌐 Тіл'}[lang], callback_data='lang')],
-    ])
     # admin button visible only to ADMIN_ID
-    if user_id == ADMIN_ID:
-        kb.inline_keyboard.append([InlineKeyboardButton(text='🛠 Admin panel', callback_data='admin_panel')])
-    return kb
+    admin = user_id == ADMIN_ID
+    return MAIN_KB.get((lang, admin)) or MAIN_KB[(DEFAULT_LANG, admin)]
 
 def lang_kb():
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(LANGS[k], callback_data=f"set_lang_{k}") for k in LANGS]])
-    return kb
+    return LANG_KB
 
 def admin_main_kb():
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text='📊 Статистика', callback_data='adm_stats'), InlineKeyboardButton(text='👤 Пользователи', callback_data='adm_users')],
-        [InlineKeyboardButton(text='💳 Заявки', callback_data='adm_orders'), InlineKeyboardButton(text='📝 Логи', callback_data='adm_logs')],
-        [InlineKeyboardButton(text='⭐ Управлять Premium', callback_data='adm_manage'), InlineKeyboardButton(text='⬅️ Назад', callback_data='adm_back')],
-    ])
-    return kb
+    return ADMIN_KB
+
+# --- Callback routing ---
+class CallbackRouter:
+    # Static callback_data is matched with one dict lookup; parameterized data ("set_lang_en",
+    # "admin_grant:123") walks a prefix trie and `parse` turns the rest into the handler's payload.
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.stats = {}  # handler name -> [hits, total seconds, max seconds]
+
+    def route(self, data=None, prefix=None, parse=str, admin=False):
+        def deco(fn):
+            r = (fn, parse if prefix is not None else None, admin)
+            if prefix is None:
+                self.exact[data] = r
+            else:
+                node = self.trie
+                for ch in prefix:
+                    node = node.setdefault(ch, {})
+                node[None] = r
+            return fn
+        return deco
+
+    def match(self, data):
+        r = self.exact.get(data)
+        if r is not None:
+            return r, None
+        node, best = self.trie, None
+        for i, ch in enumerate(data):
+            node = node.get(ch)
+            if node is None: break
+            if None in node: best = (node[None], data[i+1:])
+        return best or (None, None)
+
+    async def dispatch(self, c):
+        r, rest = self.match(c.data or '')
+        if r is None:
+            await c.answer(); return
+        fn, parse, admin = r
+        if admin and c.from_user.id != ADMIN_ID:
+            await c.answer('Unauthorized', show_alert=True); return
+        args = ()
+        if parse is not None:
+            try:
+                args = (parse(rest),)
+            except (ValueError, TypeError):
+                await c.answer('Bad request'); return
+        t0 = time.perf_counter()
+        try:
+            await fn(c, *args)
+        finally:
+            dt = time.perf_counter() - t0
+            st = self.stats.setdefault(fn.__name__, [0, 0.0, 0.0])
+            st[0] += 1; st[1] += dt; st[2] = max(st[2], dt)
+            metrics.observe('handler_seconds', dt, handler=fn.__name__)
+
+    def snapshot(self):
+        return {name: {'hits': h, 'avg_ms': round(t / h * 1000, 2) if h else 0, 'max_ms': round(m * 1000, 2)}
+                for name, (h, t, m) in self.stats.items()}
+
+callbacks = CallbackRouter()
+
+@dp.callback_query()
+async def on_callback(c: types.CallbackQuery):
+    await callbacks.dispatch(c)
+
+def parse_lang(s):
+    if s not in LANGS: raise ValueError(s)
+    return s
 
 # --- Bot handlers (based on your original bot.py) ---
 @dp.message(Command(commands=['start']))
 async def start(m: types.Message):
     tid = m.from_user.id
-    users = read_json(USERS_FILE) or {}
-    if str(tid) not in users:
-        users[str(tid)] = {"trial_left":2, "premium": False, "premium_until":0, "lang": DEFAULT_LANG, "requests":0}
-        write_json(USERS_FILE, users)
-    lang = users[str(tid)].get('lang', DEFAULT_LANG)
-    await m.answer(I18N['welcome'][lang], reply_markup=main_kb(tid, lang))
-    action_logger.info(f"start {tid}")
-
-@dp.callback_query(lambda c: c.data and c.data.startswith('set_lang_'))
-async def set_lang_cb(c: types.CallbackQuery):
-    lang = c.data.split('_')[2]
-    users = read_json(USERS_FILE) or {}
-    u = users.get(str(c.from_user.id), {})
-    u['lang'] = lang
-    users[str(c.from_user.id)] = u
-    write_json(USERS_FILE, users)
+    u, _ = users_store.setdefault(tid, new_user())
+    lang = u.get('lang', DEFAULT_LANG)
+    await m.answer(tr('welcome', lang), reply_markup=main_kb(tid, lang))
+    log_action('start', tid)
+
+@callbacks.route(prefix='set_lang_', parse=parse_lang)
+async def set_lang_cb(c: types.CallbackQuery, lang):
+    save_user(c.from_user.id, {'lang': lang})
     await c.answer("Language set ✅", show_alert=False)
     await c.message.delete()
-    await c.message.answer(I18N['welcome'][lang], reply_markup=main_kb(c.from_user.id, lang))
+    await c.message.answer(tr('welcome', lang), reply_markup=main_kb(c.from_user.id, lang))
 
-@dp.callback_query(lambda c: c.data == 'lang')
+@callbacks.route('lang')
 async def lang_menu(c: types.CallbackQuery):
     await c.answer()
     await c.message.answer("Choose language / Выберите язык / Тілді таңдаңыз", reply_markup=lang_kb())
 
-# Free AI handlers with trial handling
-async def _use_trial_or_premium(user_id, increment_request=True):
-    users = read_json(USERS_FILE) or {}
-    u = users.get(str(user_id), {"trial_left":2, "premium": False, "premium_until":0, "lang": DEFAULT_LANG, "requests":0})
-    now = int(time.time())
-    # check premium by expiry
-    if u.get('premium_until',0) and now < int(u.get('premium_until')):
-        premium = True
+# --- Per-user generation guard ---
+ai_inflight = set()
+user_buckets = OrderedDict()  # user id -> TokenBucket, least recently used first
+global_bucket = TokenBucket(AI_GLOBAL_RATE, AI_GLOBAL_BURST)
+USER_BUCKETS_MAX = 50000
+
+def ai_rate_ok(uid):
+    b = user_buckets.get(uid)
+    if b is None:
+        b = user_buckets[uid] = TokenBucket(AI_USER_RATE, AI_USER_BURST)
+        if len(user_buckets) > USER_BUCKETS_MAX: user_buckets.popitem(last=False)
     else:
+        user_buckets.move_to_end(uid)
+    if not b.try_acquire(): return False
+    if not global_bucket.try_acquire():
+        b.tokens += 1  # not the user's fault, give the token back
+        return False
+    return True
+
+@contextlib.asynccontextmanager
+async def ai_guard(c):
+    # lets one generation per user run at a time; repeated taps are answered and dropped
+    uid = c.from_user.id
+    if uid in ai_inflight:
+        await c.answer('⏳ Already generating, please wait...')
+        yield False; return
+    if not ai_rate_ok(uid):
+        await c.answer('Too many requests, please slow down.', show_alert=True)
+        yield False; return
+    ai_inflight.add(uid)
+    try:
+        yield True
+    finally:
+        ai_inflight.discard(uid)
+
+# Free AI handlers with trial handling
+async def _use_trial_or_premium(user_id, feature=None, increment_request=True):
+    def consume(u):
         premium = u.get('premium', False)
-    if increment_request:
-        u['requests'] = u.get('requests',0) + 1
-    if not premium:
-        # trial management
-        u['trial_left'] = max(0, u.get('trial_left',2))
-        if u['trial_left'] <= 0:
-            users[str(user_id)] = u
-            write_json(USERS_FILE, users)
-            return False, u
-        else:
-            u['trial_left'] = u.get('trial_left',2) - 1
-    users[str(user_id)] = u
-    write_json(USERS_FILE, users)
-    return True, u
+        if increment_request:
+            u['requests'] = u.get('requests',0) + 1
+        if not premium:
+            # trial management
+            u['trial_left'] = max(0, u.get('trial_left',2))
+            if u['trial_left'] <= 0:
+                return False
+            u['trial_left'] -= 1
+        return True
+    with state_transaction():
+        allowed, u = users_store.mutate(user_id, consume)
+        if allowed and feature:
+            users_store.bump(feature)
+    return allowed, u
+
+async def _trial_generation(c, feature, notice, prompt, lang):
+    async with ai_guard(c) as ok:
+        if not ok: return
+        allowed, u = await _use_trial_or_premium(c.from_user.id, feature)
+        if not allowed:
+            await c.answer("Trial exhausted. Buy Premium to continue.", show_alert=True)
+            await c.message.answer("Your trial is over. Please buy Premium.", reply_markup=main_kb(c.from_user.id, lang))
+            return
+        await c.answer(notice)
+        await ai_reply(c.message, feature, prompt, c.from_user.full_name, lang, counted=True)
+        log_action(feature, c.from_user.id)
 
-@dp.callback_query(lambda c: c.data == 'mini')
+@callbacks.route('mini')
 async def mini_cb(c: types.CallbackQuery):
     lang = get_user(c.from_user.id).get('lang', DEFAULT_LANG)
-    allowed, u = await _use_trial_or_premium(c.from_user.id)
-    if not allowed:
-        await c.answer("Trial exhausted. Buy Premium to continue.", show_alert=True)
-        await c.message.answer("Your trial is over. Please buy Premium.", reply_markup=main_kb(c.from_user.id, lang))
-        return
-    await c.answer(I18N['mini'][lang])
     prompt = f"Short 3-sentence mini analysis for: {c.from_user.full_name} (language: {lang})"
-    res = hf_request(prompt)
-    await c.message.answer(res)
-    action_logger.info(f"mini {c.from_user.id}")
+    await _trial_generation(c, 'mini', tr('mini', lang), prompt, lang)
 
-@dp.callback_query(lambda c: c.data == 'compat')
+@callbacks.route('compat')
 async def compat_cb(c: types.CallbackQuery):
     lang = get_user(c.from_user.id).get('lang', DEFAULT_LANG)
-    allowed, u = await _use_trial_or_premium(c.from_user.id)
-    if not allowed:
-        await c.answer("Trial exhausted. Buy Premium to continue.", show_alert=True)
-        await c.message.answer("Your trial is over. Please buy Premium.", reply_markup=main_kb(c.from_user.id, lang))
-        return
-    await c.answer("Compatibility analysis...")
     prompt = f"Short compatibility analysis for: {c.from_user.full_name} (lang:{lang})"
-    res = hf_request(prompt)
-    await c.message.answer(res)
-    action_logger.info(f"compat {c.from_user.id}")
+    await _trial_generation(c, 'compat', "Compatibility analysis...", prompt, lang)
 
-@dp.callback_query(lambda c: c.data == 'advice')
+@callbacks.route('advice')
 async def advice_cb(c: types.CallbackQuery):
     lang = get_user(c.from_user.id).get('lang', DEFAULT_LANG)
-    allowed, u = await _use_trial_or_premium(c.from_user.id)
-    if not allowed:
-        await c.answer("Trial exhausted. Buy Premium to continue.", show_alert=True)
-        await c.message.answer("Your trial is over. Please buy Premium.", reply_markup=main_kb(c.from_user.id, lang))
-        return
-    await c.answer("AI Advice...")
     prompt = f"Give a short actionable advice for: {c.from_user.full_name} (lang:{lang})"
-    res = hf_request(prompt)
-    await c.message.answer(res)
-    action_logger.info(f"advice {c.from_user.id}")
+    await _trial_generation(c, 'advice', "AI Advice...", prompt, lang)
 
-@dp.callback_query(lambda c: c.data == 'buy')
+@callbacks.route('buy')
 async def buy_cb(c: types.CallbackQuery):
     await c.answer()
     lang = get_user(c.from_user.id).get('lang', DEFAULT_LANG)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"Перевести на карту: {CARD_NUMBER}", callback_data='copy_card')],
-        [InlineKeyboardButton(text="Я оплатил", callback_data='i_paid')],
-        [InlineKeyboardButton({'en':'Back','ru':'Назад','kz':'Артқа'}[lang], callback_data='back')],
-    ])
-    await c.message.answer(f"{PRICE_STR}\nПереведите на карту: {CARD_NUMBER}\nИмя: {CARD_OWNER}", reply_markup=kb)
-
-@dp.callback_query(lambda c: c.data == 'copy_card')
+    await c.message.answer(f"{PRICE_STR}\nПереведите на карту: {CARD_NUMBER}\nИмя: {CARD_OWNER}", reply_markup=BUY_KB.get(lang, BUY_KB[DEFAULT_LANG]))
+
+@callbacks.route('copy_card')
 async def copy_card_cb(c: types.CallbackQuery):
     await c.answer('Скопировано (вставьте в приложение банка).', show_alert=True)
 
-@dp.callback_query(lambda c: c.data == 'i_paid')
+@callbacks.route('i_paid')
 async def i_paid_cb(c: types.CallbackQuery):
     tid = c.from_user.id
     add_order_manual(tid)
     await c.answer('Thanks, awaiting verification. Admin notified.')
-    try:
-        await bot.send_message(ADMIN_ID, f"Поступила заявка на проверку оплаты от @{c.from_user.username or c.from_user.full_name} (ID: {tid}).", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton('✔ Grant Premium', callback_data=f'admin_grant:{tid}')],
-                [InlineKeyboardButton('✖ Reject', callback_data=f'admin_reject:{tid}')],
-            ]))
-    except Exception as e:
-        logging.exception('notify admin failed')
+    # sent in the background under the admin chat's rate limit, so a burst of payments cannot flood it
+    spawn(broadcaster.send(ADMIN_ID, f"Поступила заявка на проверку оплаты от @{c.from_user.username or c.from_user.full_name} (ID: {tid}).", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text='✔ Grant Premium', callback_data=f'admin_grant:{tid}')],
+            [InlineKeyboardButton(text='✖ Reject', callback_data=f'admin_reject:{tid}')],
+        ])))
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('admin_grant:'))
-async def admin_grant_cb(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID: await c.answer('Unauthorized', show_alert=True); return
-    tid = c.data.split(':')[1]
-    grant_premium(tid)
+@callbacks.route(prefix='admin_grant:', parse=int, admin=True)
+async def admin_grant_cb(c: types.CallbackQuery, tid):
+    with state_transaction():
+        grant_premium(tid)
+        close_user_orders(tid, 'approved')
     await c.answer('Premium granted ✅', show_alert=True)
     await c.message.edit_text(f'Premium granted for user {tid} ✅')
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('admin_reject:'))
-async def admin_reject_cb(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID: await c.answer('Unauthorized', show_alert=True); return
-    tid = c.data.split(':')[1]
-    # remove pending orders
-    orders = read_json(ORDERS_FILE) or []
-    orders = [o for o in orders if o.get('telegram_id') != str(tid)]
-    write_json(ORDERS_FILE, orders)
+@callbacks.route(prefix='admin_reject:', parse=int, admin=True)
+async def admin_reject_cb(c: types.CallbackQuery, tid):
+    close_user_orders(tid, 'rejected')
     await c.answer('Payment rejected', show_alert=True)
     await c.message.edit_text(f'Payment rejected for user {tid} ❌')
 
-@dp.callback_query(lambda c: c.data == 'premium')
+@callbacks.route('premium')
 async def premium_menu(c: types.CallbackQuery):
     lang = get_user(c.from_user.id).get('lang', DEFAULT_LANG)
     if check_premium(c.from_user.id):
-        await c.answer(I18N['premium_active'][lang])
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton({'en':'🧠 Deep portrait','ru':'🧠 Глубокий портрет','kz':'🧠 Терең портрет'}[lang], callback_data='deep_portrait')],
-            [InlineKeyboardButton({'en':'❤️ Relationship PRO','ru':'❤️ Relationship PRO','kz':'❤️ Relationship PRO'}[lang], callback_data='relationship_pro')],
-            [InlineKeyboardButton({'en':'🔍 Partner analysis','ru':'🔍 Разбор партнёра','kz':'🔍 Серіктес талдауы'}[lang], callback_data='partner')],
-            [InlineKeyboardButton({'en':'🔁 Back','ru':'🔁 Назад','kz':'🔁 Артқа'}[lang], callback_data='back')],
-        ])
-        await c.message.answer('Premium menu:', reply_markup=kb)
+        await c.answer(tr('premium_active', lang))
+        await c.message.answer('Premium menu:', reply_markup=PREMIUM_KB.get(lang, PREMIUM_KB[DEFAULT_LANG]))
     else:
-        await c.answer(I18N['no_premium'][lang])
+        await c.answer(tr('no_premium', lang))
 
-@dp.callback_query(lambda c: c.data == 'deep_portrait')
+@callbacks.route('deep_portrait')
 async def deep_portrait_cb(c: types.CallbackQuery):
-    await c.answer('Generating deep portrait...')
-    prompt = f"Detailed psychological portrait for: {c.from_user.full_name}"
-    res = hf_request(prompt)
-    await c.message.answer(res)
+    async with ai_guard(c) as ok:
+        if not ok: return
+        await c.answer('Generating deep portrait...')
+        lang = get_user(c.from_user.id).get('lang', DEFAULT_LANG)
+        prompt = f"Detailed psychological portrait for: {c.from_user.full_name}"
+        await ai_reply(c.message, 'deep_portrait', prompt, c.from_user.full_name, lang)
 
-@dp.callback_query(lambda c: c.data == 'relationship_pro')
+@callbacks.route('relationship_pro')
 async def relpro_cb(c: types.CallbackQuery):
-    await c.answer('Generating Relationship PRO...')
-    prompt = f"Detailed relationship analysis for: {c.from_user.full_name}"
-    res = hf_request(prompt)
-    await c.message.answer(res)
+    async with ai_guard(c) as ok:
+        if not ok: return
+        await c.answer('Generating Relationship PRO...')
+        lang = get_user(c.from_user.id).get('lang', DEFAULT_LANG)
+        prompt = f"Detailed relationship analysis for: {c.from_user.full_name}"
+        await ai_reply(c.message, 'relationship_pro', prompt, c.from_user.full_name, lang)
 
-@dp.callback_query(lambda c: c.data == 'partner')
+@callbacks.route('partner')
 async def partner_cb(c: types.CallbackQuery):
-    await c.answer('Generating partner analysis...')
-    prompt = f"Analyze partner behavior for: {c.from_user.full_name}"
-    res = hf_request(prompt)
-    await c.message.answer(res)
+    async with ai_guard(c) as ok:
+        if not ok: return
+        await c.answer('Generating partner analysis...')
+        lang = get_user(c.from_user.id).get('lang', DEFAULT_LANG)
+        prompt = f"Analyze partner behavior for: {c.from_user.full_name}"
+        await ai_reply(c.message, 'partner', prompt, c.from_user.full_name, lang)
 
-@dp.callback_query(lambda c: c.data == 'status')
+@callbacks.route('status')
 async def status_cb(c: types.CallbackQuery):
     u = get_user(c.from_user.id)
     if check_premium(c.from_user.id):
@@ -353,62 +1973,113 @@ async def status_cb(c: types.CallbackQuery):
         await c.answer('No Premium')
         await c.message.answer('У вас нет Premium. Купите, чтобы получить доступ.')
 
-@dp.callback_query(lambda c: c.data == 'back')
+@callbacks.route('back')
 async def back_cb(c: types.CallbackQuery):
-    await c.message.answer('Back to menu', reply_markup=main_kb(get_user(c.from_user.id).get('lang', DEFAULT_LANG)))
+    await c.answer()
+    await c.message.answer('Back to menu', reply_markup=main_kb(c.from_user.id, get_user(c.from_user.id).get('lang', DEFAULT_LANG)))
+
 # --- Admin panel callbacks ---
-@dp.callback_query(lambda c: c.data == 'admin_panel')
+@callbacks.route('admin_panel', admin=True)
 async def admin_panel_cb(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        await c.answer('Unauthorized', show_alert=True); return
     await c.answer(); await c.message.answer('Admin panel', reply_markup=admin_main_kb())
 
-@dp.callback_query(lambda c: c.data and c.data.startswith('adm_'))
-async def adm_cb(c: types.CallbackQuery):
-    if c.from_user.id != ADMIN_ID:
-        await c.answer('Unauthorized', show_alert=True); return
-    cmd = c.data
-    if cmd == 'adm_stats':
-        users = read_json(USERS_FILE) or {}
-        total = len(users)
-        premium = sum(1 for u in users.values() if u.get('premium_until',0) and int(time.time()) < int(u.get('premium_until')))
-        trials = sum(1 for u in users.values() if u.get('trial_left',0) > 0)
-        text = f"📊 Статистика\n\nВсего пользователей: {total}\nPremium активны: {premium}\nТриал остался у: {trials}"
-        await c.message.edit_text(text, reply_markup=admin_main_kb()); await c.answer()
-    elif cmd == 'adm_users':
-        users = read_json(USERS_FILE) or {}
-        lines = []
-        for uid,u in list(users.items())[:100]:
-            pu = "Да" if u.get('premium_until',0) and int(time.time()) < int(u.get('premium_until')) else "Нет"
-            lines.append(f"{uid} | premium:{pu} | trial_left:{u.get('trial_left',0)}")
-        await c.message.edit_text("👥 Пользователи:\n" + ("\n".join(lines) if lines else "Нет пользователей"), reply_markup=admin_main_kb()); await c.answer()
-    elif cmd == 'adm_orders':
-        orders = read_json(ORDERS_FILE) or []
-        lines = []
-        for o in orders[::-1][:50]:
-            ts = datetime.datetime.fromtimestamp(o.get('timestamp',0)).strftime("%Y-%m-%d %H:%M")
-            lines.append(f"{o.get('telegram_id')} | {ts} | {o.get('status')} | {o.get('id')}")
-        await c.message.edit_text("💳 Заявки:\n" + ("\n".join(lines) if lines else "Нет заявок"), reply_markup=admin_main_kb()); await c.answer()
-    elif cmd == 'adm_logs':
-        if os.path.exists(ACTIONS_LOG):
-            await c.message.answer_document(FSInputFile(ACTIONS_LOG))
-        else:
-            await c.message.answer("Логов нет."); await c.answer()
-    elif cmd == 'adm_manage':
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text='Выдать Premium (ID)', callback_data='adm_grant_prompt')],
-            [InlineKeyboardButton(text='Забрать Premium (ID)', callback_data='adm_revoke_prompt')],
-            [InlineKeyboardButton(text='⬅️ Назад', callback_data='adm_back')],
-        ])
-        await c.message.edit_text("⭐ Управление Premium", reply_markup=kb); await c.answer()
-    elif cmd == 'adm_grant_prompt':
-        await c.message.answer("Отправь: grant:<user_id>"); await c.answer()
-    elif cmd == 'adm_revoke_prompt':
-        await c.message.answer("Отправь: revoke:<user_id>"); await c.answer()
-    elif cmd == 'adm_back':
-        await c.message.edit_text("Admin panel", reply_markup=admin_main_kb()); await c.answer()
-
-@dp.message(lambda m: m.from_user.id == ADMIN_ID and m.text and (m.text.startswith('grant:') or m.text.startswith('revoke:')))
+@callbacks.route('adm_stats', admin=True)
+async def adm_stats_cb(c: types.CallbackQuery):
+    st = users_store.stats()
+    cs = ai_cache.snapshot()
+    reqs = ", ".join(f"{f}: {n}" for f, n in requests_by_feature().items())
+    text = f"📊 Статистика\n\nВсего пользователей: {st['total_users']}\nPremium активны: {st['premium_active']}\nТриал остался у: {st['trial_left']}\nЗапросы: {reqs}\nAI кэш: {cs['hits_mem']+cs['hits_disk']} попаданий / {cs['misses']} промахов"
+    await c.message.edit_text(text, reply_markup=admin_main_kb()); await c.answer()
+
+@callbacks.route('adm_users', admin=True)
+async def adm_users_cb(c: types.CallbackQuery):
+    lines = []
+    for uid,u in users_store.head(100):
+        pu = "Да" if u.get('premium') else "Нет"
+        lines.append(f"{uid} | premium:{pu} | trial_left:{u.get('trial_left',0)}")
+    await c.message.edit_text("👥 Пользователи:\n" + ("\n".join(lines) if lines else "Нет пользователей"), reply_markup=admin_main_kb()); await c.answer()
+
+@callbacks.route('adm_orders', admin=True)
+async def adm_orders_cb(c: types.CallbackQuery):
+    lines = []
+    for o in orders_journal.last(50):
+        ts = datetime.datetime.fromtimestamp(o.get('timestamp',0)).strftime("%Y-%m-%d %H:%M")
+        lines.append(f"{o.get('telegram_id')} | {ts} | {o.get('status')} | {o.get('id')}")
+    await c.message.edit_text("💳 Заявки:\n" + ("\n".join(lines) if lines else "Нет заявок"), reply_markup=admin_main_kb()); await c.answer()
+
+def format_log_lines(lines):
+    out = []
+    for raw in lines:
+        try:
+            r = json.loads(raw)
+            extra = ' '.join(f"{k}={v}" for k, v in r.items() if k not in ('ts', 'event', 'uid'))
+            out.append(f"{r.get('ts','')[5:19].replace('T',' ')} {r.get('event')} {r.get('uid','')} {extra}".rstrip())
+        except (ValueError, AttributeError):
+            out.append(raw)
+    text = "\n".join(out)
+    return text[-3800:] if len(text) > 3800 else text
+
+@callbacks.route('adm_logs', admin=True)
+async def adm_logs_cb(c: types.CallbackQuery):
+    lines = await asyncio.to_thread(tail_log, ACTIONS_LOG, 30)
+    text = "📝 Последние действия:\n" + (format_log_lines(lines) if lines else "Логов нет.") + "\n\nФильтр по пользователю: logs:<user_id>"
+    await c.message.edit_text(text, reply_markup=ADMIN_LOGS_KB); await c.answer()
+
+@callbacks.route('adm_logs_file', admin=True)
+async def adm_logs_file_cb(c: types.CallbackQuery):
+    if os.path.exists(ACTIONS_LOG):
+        await c.message.answer_document(FSInputFile(ACTIONS_LOG))
+    else:
+        await c.message.answer("Логов нет.")
+    await c.answer()
+
+@callbacks.route('adm_manage', admin=True)
+async def adm_manage_cb(c: types.CallbackQuery):
+    await c.message.edit_text("⭐ Управление Premium", reply_markup=ADMIN_MANAGE_KB); await c.answer()
+
+@callbacks.route('adm_grant_prompt', admin=True)
+async def adm_grant_prompt_cb(c: types.CallbackQuery):
+    await c.message.answer("Отправь: grant:<user_id>"); await c.answer()
+
+@callbacks.route('adm_revoke_prompt', admin=True)
+async def adm_revoke_prompt_cb(c: types.CallbackQuery):
+    await c.message.answer("Отправь: revoke:<user_id>"); await c.answer()
+
+def broadcast_text():
+    p = broadcaster.progress()
+    if p is None:
+        return "📣 Рассылок ещё не было.\n\nНовая рассылка: broadcast:<текст>"
+    status = {'running': 'идёт', 'done': 'завершена', 'cancelled': 'остановлена'}.get(p['status'], p['status'])
+    pct = p['done'] * 100 // p['total'] if p['total'] else 100
+    text = (f"📣 Рассылка {p['id']}: {status}\n"
+            f"Прогресс: {p['done']}/{p['total']} ({pct}%)\n"
+            f"Доставлено: {p['sent']} · заблокировали: {p['blocked']} · ошибки: {p['failed']}\n"
+            f"Скорость: {p['rate']:.1f} сообщ/с")
+    if p['status'] == 'running' and p['eta'] is not None:
+        text += f", осталось ~{datetime.timedelta(seconds=int(p['eta']))}"
+    return text + "\n\nНовая рассылка: broadcast:<текст>"
+
+@callbacks.route('adm_broadcast', admin=True)
+async def adm_broadcast_cb(c: types.CallbackQuery):
+    try:
+        await c.message.edit_text(broadcast_text(), reply_markup=ADMIN_BROADCAST_KB)
+    except TelegramBadRequest:
+        pass  # refreshed without changes
+    await c.answer()
+
+@callbacks.route('adm_broadcast_stop', admin=True)
+async def adm_broadcast_stop_cb(c: types.CallbackQuery):
+    await c.answer('Рассылка остановлена' if broadcaster.cancel() else 'Нет активной рассылки', show_alert=True)
+
+@callbacks.route('adm_back', admin=True)
+async def adm_back_cb(c: types.CallbackQuery):
+    await c.message.edit_text("Admin panel", reply_markup=admin_main_kb()); await c.answer()
+
+@callbacks.route(prefix='adm_', admin=True)
+async def adm_unknown_cb(c: types.CallbackQuery, cmd):
+    await c.answer()
+
+@dp.message(lambda m: m.from_user.id == ADMIN_ID and m.text and m.text.startswith(('grant:', 'revoke:', 'logs:', 'broadcast:')))
 async def admin_text_actions(message: types.Message):
     parts = message.text.split(':',1)
     if len(parts)<2: return
@@ -419,45 +2090,636 @@ async def admin_text_actions(message: types.Message):
     elif action == 'revoke':
         revoke_premium(uid)
         await message.reply(f"❌ Premium отозван у {uid}")
+    elif action == 'logs':
+        lines = await asyncio.to_thread(tail_log, ACTIONS_LOG, 30, uid)
+        await message.reply(f"📝 Действия {uid}:\n" + (format_log_lines(lines) if lines else "Нет записей."))
+    elif action == 'broadcast':
+        if not parts[1].strip(): return
+        if broadcaster.start(parts[1].strip()) is None:
+            await message.reply("Рассылка уже идёт, дождитесь окончания или остановите её.")
+        else:
+            await message.reply(broadcast_text(), reply_markup=ADMIN_BROADCAST_KB)
+
+# --- Premium expiry ---
+class ExpiryScheduler:
+    # Sleeps until the earliest premium_until in the store's expiry index (a sorted list used as
+    # a priority queue), revokes everything due in batches and queues renewal reminders. Revoked
+    # users keep renew_pending in the store until their reminder went out, so reminders still
+    # queued at shutdown are picked up again on startup.
+    CLAIM_TTL = 300  # seconds a reminder claimed by one process is left alone by the others
+
+    def __init__(self, store, batch=500, reminder_rate=10, max_sleep=3600):
+        self.store, self.batch, self.max_sleep = store, batch, max_sleep
+        self.bucket = TokenBucket(reminder_rate, reminder_rate)
+        self.reminders = asyncio.Queue()
+        self.wake = asyncio.Event()
+        self.loop = None
+        self.revoked = 0
+
+    def notify(self):
+        # a deadline was added or moved; safe to call from any thread
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            for key in self.store.renew_pending():
+                self.reminders.put_nowait(key)
+        except Exception:
+            logging.exception('pending renewal reminders')
+        while True:
+            self.wake.clear()
+            now = int(time.time())
+            try:
+                due = self.store.expire_due(now, self.batch)
+            except Exception:
+                logging.exception('premium expiry')
+                await asyncio.sleep(5)
+                continue
+            for key in due:
+                self.reminders.put_nowait(key)
+                log_action('premium_expired', key)
+            self.revoked += len(due)
+            nxt = self.store.next_expiry()
+            if nxt is not None and nxt <= now:
+                await asyncio.sleep(0)  # more due: let handlers run between batches
+                continue
+            timeout = min(self.max_sleep, max(0, nxt - time.time())) if nxt else self.max_sleep
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-# --- Flask API (for Replit web) ---
-app = Flask('lovesense_api')
-
-@app.route('/user_status/<uid>', methods=['GET'])
-def api_user_status(uid):
-    users = read_json(USERS_FILE) or {}
-    return jsonify(users.get(str(uid), {}))
-
-@app.route('/orders', methods=['GET'])
-def api_orders():
-    return jsonify(read_json(ORDERS_FILE) or [])
-
-@app.route('/admin/grant', methods=['POST'])
-def api_admin_grant():
-    data = flask_request.get_json() or {}
-    if str(data.get('admin_id')) != str(ADMIN_ID): return jsonify({'error':'unauthorized'}), 403
-    uid = data.get('uid')
-    grant_premium(uid)
-    return jsonify({'ok':True})
-
-@app.route('/admin/revoke', methods=['POST'])
-def api_admin_revoke():
-    data = flask_request.get_json() or {}
-    if str(data.get('admin_id')) != str(ADMIN_ID): return jsonify({'error':'unauthorized'}), 403
-    uid = data.get('uid')
-    revoke_premium(uid)
-    return jsonify({'ok':True})
-
-def run_flask():
-    app.run(host='0.0.0.0', port=SERVER_PORT)
+    def _claim(self, u, now):
+        # renew_pending is True when queued and the claim time while a process is sending it
+        p = u.get('renew_pending')
+        if p and u.get('premium'):
+            u.pop('renew_pending')  # renewed in the meantime
+            return False
+        if not p or (p is not True and now - p < self.CLAIM_TTL): return False
+        u['renew_pending'] = now
+        return True
+
+    async def remind_loop(self):
+        while True:
+            key = await self.reminders.get()
+            try:
+                if key not in self.store: continue
+                claimed, u = self.store.mutate(key, lambda u: self._claim(u, int(time.time())))
+                if not claimed: continue  # already reminded, or another process is on it
+                await self.bucket.acquire()
+                lang = u.get('lang', DEFAULT_LANG)
+                outcome = await broadcaster.send(int(key), tr('premium_expired', lang), reply_markup=BUY_KB.get(lang, BUY_KB[DEFAULT_LANG]))
+                # a failed send stays pending (unclaimed) for the next startup
+                self.store.mutate(key, lambda u: u.update(renew_pending=True) if outcome == 'failed' else u.pop('renew_pending', None))
+            except Exception:
+                logging.exception('renewal reminder %s', key)
+
+# with a shared database other processes grant premiums without notify() reaching this one
+expiry_scheduler = ExpiryScheduler(users_store, EXPIRY_BATCH, REMINDER_RATE, 60 if STATE_BACKEND == 'sqlite' else 3600)
+
+# --- Broadcasts ---
+class Broadcaster:
+    # Every bot-initiated message goes through send(): a global and a per-chat TokenBucket, a
+    # semaphore on sends in flight, and a shared pause when Telegram answers with retry_after
+    # (the flood limit is per bot, so every sender waits it out). A broadcast job walks the
+    # user store with page_ids() and checkpoints its cursor and counters to `state` per batch.
+    # The job is sent by the process holding its lease (owner, lease_until), renewed while it
+    # runs; other processes read progress and cancel through the same state, and take the job
+    # over only once the lease has lapsed.
+    CHAT_BUCKETS_MAX = 10000
+    LEASE = 60
+
+    def __init__(self, store, state, rate=25, chat_rate=1, concurrency=16, batch=200, retries=5):
+        self.store, self.state = store, state
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate, self.batch, self.retries = chat_rate, batch, retries
+        self.chat_buckets = OrderedDict()  # chat id -> TokenBucket, least recently used first
+        self.sem = asyncio.Semaphore(concurrency)
+        self.paused_until = 0.0
+        self.task = None  # the job this process is sending
+
+    def _chat_bucket(self, chat_id):
+        b = self.chat_buckets.get(chat_id)
+        if b is None:
+            b = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+            if len(self.chat_buckets) > self.CHAT_BUCKETS_MAX: self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return b
+
+    async def send(self, chat_id, text, **kw):
+        # returns 'sent', 'blocked' (the user blocked the bot or the chat is gone) or 'failed'
+        outcome = 'failed'
+        async with self.sem:
+            for attempt in range(self.retries):
+                await self._chat_bucket(chat_id).acquire()
+                await self.bucket.acquire()
+                wait = self.paused_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    await bot.send_message(chat_id, text, **kw)
+                    outcome = 'sent'; break
+                except TelegramRetryAfter as e:
+                    self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                    metrics.inc('broadcast_flood_waits')
+                except (TelegramForbiddenError, TelegramBadRequest):
+                    outcome = 'blocked'; break
+                except Exception:
+                    logging.exception('send to %s', chat_id)
+                    break
+        metrics.inc('outgoing_messages', outcome=outcome)
+        return outcome
+
+    def start(self, text):
+        now = int(time.time())
+        job = {'id': f'bc_{time.time_ns() // 1000000}', 'text': text, 'status': 'running', 'cursor': 0,
+               'total': len(self.store), 'sent': 0, 'blocked': 0, 'failed': 0,
+               'started': now, 'finished': None, 'owner': None, 'lease_until': 0}
+        if not self.state.create(job): return None
+        log_action('broadcast_start', ADMIN_ID, broadcast=job['id'], total=job['total'])
+        self._take(job['id'])
+        return job
+
+    def _claim(self, job):
+        now = time.time()
+        if job.get('status') != 'running': return False
+        if job.get('owner') not in (None, self.owner) and job.get('lease_until', 0) > now: return False
+        if job.get('owner') != self.owner:
+            job['run_started'], job['run_base'] = now, self.done(job)  # for the throughput of this run
+        job['owner'], job['lease_until'] = self.owner, now + self.LEASE
+        return True
+
+    def _take(self, job_id):
+        if self.task is not None and not self.task.done(): return False
+        if self.state.update(job_id, self._claim) is None: return False
+        self.task = spawn(self._run(job_id))
+        return True
+
+    async def watch(self):
+        # resumes an unfinished job on startup and takes over one whose owner stopped renewing
+        while True:
+            try:
+                job = self.state.current()
+                if job and job.get('status') == 'running' and self._take(job['id']):
+                    logging.info('broadcast %s: resuming at %s/%s', job['id'], self.done(job), job['total'])
+            except Exception:
+                logging.exception('broadcast watch')
+            await asyncio.sleep(self.LEASE / 2)
+
+    def cancel(self):
+        job = self.state.current()
+        if not job or job.get('status') != 'running': return False
+        def stop(j):
+            if j.get('status') != 'running': return False
+            j['status'], j['finished'] = 'cancelled', int(time.time())
+            return True
+        if self.state.update(job['id'], stop) is None: return False
+        # the owner, if it is another process, notices at its next checkpoint or lease renewal
+        if self.task is not None and not self.task.done(): self.task.cancel()
+        log_action('broadcast_cancel', ADMIN_ID, broadcast=job['id'], done=self.done(job))
+        return True
+
+    @staticmethod
+    def done(job):
+        return job['sent'] + job['blocked'] + job['failed'] if job else 0
+
+    def _mine(self, j):
+        return j.get('status') == 'running' and j.get('owner') == self.owner
+
+    async def _heartbeat(self, job_id, runner):
+        def renew(j):
+            if not self._mine(j): return False
+            j['lease_until'] = time.time() + self.LEASE
+            return True
+        while True:
+            await asyncio.sleep(self.LEASE / 3)
+            if self.state.update(job_id, renew) is None:
+                runner.cancel()  # cancelled elsewhere, or the lease was lost
+                return
+
+    async def _run(self, job_id):
+        job = self.state.current()
+        hb = spawn(self._heartbeat(job_id, asyncio.current_task()))
+        try:
+            while job is not None:
+                ids, cursor = self.store.page_ids(job['cursor'], self.batch)
+                if not ids:
+                    def finish(j):
+                        if not self._mine(j): return False
+                        j['status'], j['finished'] = 'done', int(time.time())
+                        j['total'] = max(j['total'], self.done(j))
+                        return True
+                    job = self.state.update(job_id, finish)
+                    if job:
+                        log_action('broadcast_done', ADMIN_ID, broadcast=job_id, sent=job['sent'], blocked=job['blocked'], failed=job['failed'])
+                    break
+                counts = Counter(await asyncio.gather(*(self.send(k, job['text']) for k in ids)))
+                def advance(j):
+                    if not self._mine(j): return False
+                    for outcome, n in counts.items(): j[outcome] += n
+                    j['cursor'], j['lease_until'] = cursor, time.time() + self.LEASE
+                    return True
+                job = self.state.update(job_id, advance)  # None: cancelled or taken over
+        finally:
+            hb.cancel()
+
+    def progress(self):
+        job = self.state.current()
+        if job is None: return None
+        done = self.done(job)
+        started = job.get('run_started', job['started'])
+        elapsed = (job['finished'] or time.time()) - started
+        ran = done - job.get('run_base', 0)
+        rate = ran / elapsed if ran > 0 and elapsed > 0 else 0.0
+        eta = (job['total'] - done) / rate if rate else None
+        return dict({k: job[k] for k in ('id', 'status', 'total', 'sent', 'blocked', 'failed', 'started', 'finished', 'owner')},
+                    done=done, rate=rate, eta=max(0.0, eta) if eta is not None else None)
+
+class BroadcastFileState:
+    # the current job in a JSON file, for the single-process JSON backend
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def current(self):
+        return (read_json(self.path) or None) if os.path.exists(self.path) else None
+
+    def create(self, job):
+        with self.lock:
+            cur = self.current()
+            if cur and cur.get('status') == 'running': return False
+            write_json(self.path, job, indent=None, fsync=True)
+            return True
+
+    def update(self, job_id, fn):
+        # fn changes the job in place and returns True to save it; returns the saved job or None
+        with self.lock:
+            job = self.current()
+            if not job or job['id'] != job_id or not fn(job): return None
+            write_json(self.path, job, indent=None, fsync=True)
+            return job
+
+class BroadcastDbState:
+    # the same on the shared database: every read-modify-write is one transaction, so claiming
+    # the lease, checkpointing and cancelling from different processes never interleave
+    def __init__(self, pool):
+        self.pool = pool
+
+    def _current(self, db):
+        r = db.execute('SELECT data FROM broadcasts ORDER BY started DESC, rowid DESC LIMIT 1').fetchone()
+        return json.loads(r[0]) if r else None
+
+    def current(self):
+        with self.pool.conn() as db:
+            return self._current(db)
+
+    def create(self, job):
+        with self.pool.tx() as db:
+            cur = self._current(db)
+            if cur and cur.get('status') == 'running': return False
+            db.execute('INSERT INTO broadcasts (id, started, data) VALUES (?, ?, ?)',
+                       (job['id'], job['started'], json.dumps(job, ensure_ascii=False)))
+            return True
+
+    def update(self, job_id, fn):
+        with self.pool.tx() as db:
+            r = db.execute('SELECT data FROM broadcasts WHERE id = ?', (job_id,)).fetchone()
+            job = json.loads(r[0]) if r else None
+            if job is None or not fn(job): return None
+            db.execute('UPDATE broadcasts SET data = ? WHERE id = ?', (json.dumps(job, ensure_ascii=False), job_id))
+            return job
+
+broadcaster = Broadcaster(users_store, BroadcastDbState(state_db) if STATE_BACKEND == 'sqlite' else BroadcastFileState(BROADCAST_FILE), BROADCAST_RATE, BROADCAST_CHAT_RATE, BROADCAST_CONCURRENCY, BROADCAST_BATCH)
+
+# --- Instrumentation ---
+class MessageTiming(BaseMiddleware):
+    # message handlers; callback handlers are timed by CallbackRouter
+    async def __call__(self, handler, event, data):
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            h = data.get('handler')
+            metrics.observe('handler_seconds', time.perf_counter() - t0, handler=h.callback.__name__ if h else 'unknown')
+
+class BotCallTiming(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        t0, outcome = time.perf_counter(), 'ok'
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            metrics.observe('bot_call_seconds', time.perf_counter() - t0, method=type(method).__name__, outcome=outcome)
+
+dp.message.middleware(MessageTiming())
+bot.session.middleware(BotCallTiming())
+
+loop_lag = {'last': 0.0, 'max': 0.0}
+
+async def monitor_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - t - interval)
+        loop_lag['last'], loop_lag['max'] = lag, max(loop_lag['max'], lag)
+        metrics.observe('event_loop_lag_seconds', lag)
+
+def _pick(d, keys):
+    return {k: d[k] for k in keys if k in d}
+
+# levels
+metrics.gauge('users', lambda: users_store.stats())
+metrics.gauge('ai_cache', lambda: _pick(ai_cache.snapshot(), ('entries_mem', 'disk_bytes')))
+metrics.gauge('ai_client', lambda: {'waiting': ai_client.waiting, 'in_flight': ai_client.concurrency - ai_client._sem._value})
+metrics.gauge('ai_generations_in_flight', lambda: len(ai_inflight))
+metrics.gauge('update_queue', lambda: _pick(update_queue.metrics(), ('depth', 'capacity', 'workers', 'oldest_age')))
+metrics.gauge('event_loop_lag_seconds_last', lambda: loop_lag['last'])
+metrics.gauge('broadcast', lambda: _pick(broadcaster.progress() or {}, ('total', 'done', 'rate')))
+# totals
+metrics.counter('requests', requests_by_feature, label='feature')
+metrics.counter('ai_cache_events', lambda: _pick(ai_cache.snapshot(), ('hits_mem', 'hits_disk', 'misses', 'stores', 'evictions_mem', 'evictions_disk')))
+metrics.counter('ai_batcher_events', lambda: ai_batcher.stats)
+metrics.counter('ai_stream_events', lambda: _pick(stream_stats, ('streams', 'fallbacks')))
+metrics.counter('ai_stream_seconds', lambda: {'ttft': stream_stats['ttft_sum'], 'total': stream_stats['total_sum']})
+metrics.counter('updates', lambda: _pick(update_queue.metrics(), ('received', 'rejected', 'processed', 'failed')))
+metrics.counter('premium_revoked', lambda: expiry_scheduler.revoked)
+
+# --- Background tasks ---
+background_tasks = set()
+
+def spawn(coro):
+    t = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(t)
+    t.add_done_callback(background_tasks.discard)
+    return t
+
+async def on_startup():
+    spawn(monitor_loop_lag())
+    spawn(expiry_scheduler.run())
+    spawn(expiry_scheduler.remind_loop())
+    spawn(broadcaster.watch())
+
+async def on_shutdown():
+    for t in list(background_tasks):
+        t.cancel()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+# --- Webhook ingestion ---
+class UpdateQueue:
+    # Bounded buffer between the webhook endpoint and a fixed pool of workers feeding `dp`
+    def __init__(self, size, workers):
+        self.queue = asyncio.Queue(maxsize=size)
+        self.enqueued = deque()  # monotonic enqueue times, same order as the queue
+        self.workers = workers
+        self.tasks = []
+        self.accepting = True
+        self.stats = {'received': 0, 'rejected': 0, 'processed': 0, 'failed': 0}
+
+    def put(self, update):
+        if not self.accepting:
+            return False
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            return False
+        self.enqueued.append(time.monotonic())
+        self.stats['received'] += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            self.enqueued.popleft()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                self.stats['failed'] += 1
+                logging.exception('update %s', update.update_id)
+            finally:
+                self.stats['processed'] += 1
+                self.queue.task_done()
+
+    def start(self):
+        self.tasks = [spawn(self._worker()) for _ in range(self.workers)]
+
+    async def drain(self, timeout):
+        # stop taking updates (Telegram will redeliver them) and let queued ones finish
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning('drain timed out with %s updates queued', self.queue.qsize())
+        for t in self.tasks:
+            t.cancel()
+
+    def metrics(self):
+        return dict(self.stats, depth=self.queue.qsize(), capacity=self.queue.maxsize, workers=self.workers,
+                    oldest_age=round(time.monotonic() - self.enqueued[0], 3) if self.enqueued else 0.0,
+                    accepting=self.accepting)
+
+update_queue = UpdateQueue(UPDATE_QUEUE_SIZE, UPDATE_WORKERS)
+
+async def webhook_handler(request):
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    try:
+        update = types.Update.model_validate(await request.json(), context={'bot': bot})
+    except Exception:
+        return web.Response(status=400)
+    if not update_queue.put(update):
+        return web.Response(status=503)
+    return web.Response()
+
+async def webhook_metrics(request):
+    return web.json_response(update_queue.metrics())
+
+# --- HTTP API (for Replit web) ---
+# Served by aiohttp on the bot's own event loop, so handlers share in-process state with the bot
+routes = web.RouteTableDef()
+
+def not_modified(request, etag):
+    return etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]
+
+def json_response(request, obj, etag=None):
+    body = json.dumps(obj, ensure_ascii=False)
+    etag = etag or '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()
+    if not_modified(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+    return web.Response(text=body, content_type='application/json', headers={'ETag': etag})
+
+async def admin_payload(request):
+    try:
+        data = await request.json()
+    except Exception:
+        data = None
+    if not isinstance(data, dict) or str(data.get('admin_id')) != str(ADMIN_ID):
+        raise web.HTTPForbidden(text=json.dumps({'error':'unauthorized'}), content_type='application/json')
+    return data
+
+@routes.get('/user_status/{uid}')
+async def api_user_status(request):
+    return json_response(request, users_store.get(request.match_info['uid']) or {})
+
+@routes.get('/orders')
+async def api_orders(request):
+    try:
+        cursor = request.query.get('cursor')
+        cursor = int(cursor) if cursor else None
+        limit = min(max(int(request.query.get('limit', 50)), 1), 500)
+    except ValueError:
+        return web.json_response({'error':'bad cursor or limit'}, status=400)
+    etag = f'"{orders_journal.version}-{cursor}-{limit}"'
+    if not_modified(request, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+    orders, next_cursor = orders_journal.page(cursor, limit)
+    return json_response(request, {'orders': orders, 'next_cursor': next_cursor}, etag)
+
+@routes.get('/ai_cache')
+async def api_ai_cache(request):
+    return web.json_response(ai_cache.snapshot())
+
+@routes.get('/stats')
+async def api_stats(request):
+    return web.json_response(dict(users_store.stats(), requests_by_feature=requests_by_feature()))
+
+@routes.get('/metrics')
+async def api_metrics(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+@routes.get('/debug/profiler')
+async def api_profiler_dump(request):
+    if not PROFILER_ENABLED or request.query.get('admin_id') != str(ADMIN_ID):
+        return web.json_response({'error':'unauthorized'}, status=403)
+    return web.Response(text=profiler.dump(int(request.query.get('top', 50))), content_type='text/plain')
+
+@routes.post('/debug/profiler')
+async def api_profiler_toggle(request):
+    # {"admin_id": ..., "action": "start" | "stop"}; GET the same path for the hottest stacks
+    data = await admin_payload(request)
+    if not PROFILER_ENABLED:
+        return web.json_response({'error':'profiler disabled, set PROFILER_ENABLED=1'}, status=403)
+    if data.get('action') == 'stop':
+        profiler.stop()
+        return web.json_response({'ok':True, 'stacks':len(profiler.samples)})
+    return web.json_response({'ok':profiler.start(threading.get_ident())})
+
+@routes.get('/routes')
+async def api_routes(request):
+    return web.json_response(callbacks.snapshot())
+
+def valid_uid(uid):
+    # Telegram ids arrive as strings or integers; bool is an int subclass, so it is excluded by hand
+    return not isinstance(uid, bool) and isinstance(uid, (str, int)) and uid != ''
+
+@routes.post('/admin/grant')
+async def api_admin_grant(request):
+    # {"uid": ...} for one user or {"uids": [...]} to grant a list in one call; optional "days"
+    data = await admin_payload(request)
+    uids = data.get('uids') if 'uids' in data else [data.get('uid')]
+    if not isinstance(uids, list) or not uids or len(uids) > 10000 or not all(map(valid_uid, uids)):
+        return web.json_response({'error':'uid or uids required: ids as strings or integers, at most 10000'}, status=400)
+    days = data.get('days', 30)
+    if isinstance(days, bool) or not isinstance(days, int) or not 0 < days <= 3650:
+        return web.json_response({'error':'days must be an integer from 1 to 3650'}, status=400)
+
+    def grant_chunk(chunk):
+        with state_transaction():
+            for uid in chunk:
+                grant_premium(uid, days)
+    # chunks are atomic only on SQLite; with the JSON files a failure can leave part of a chunk
+    # granted. Either way the ids before the failing chunk stay granted and are reported back
+    granted = 0
+    for i in range(0, len(uids), ADMIN_GRANT_CHUNK):
+        chunk = uids[i:i + ADMIN_GRANT_CHUNK]
+        try:
+            await asyncio.to_thread(grant_chunk, chunk)
+        except Exception as e:
+            logging.exception('admin grant failed after %d of %d ids', granted, len(uids))
+            return web.json_response({'error':str(e), 'granted':granted}, status=500)
+        granted += len(chunk)
+    return web.json_response({'ok':True, 'granted':granted})
+
+@routes.post('/admin/revoke')
+async def api_admin_revoke(request):
+    data = await admin_payload(request)
+    if not valid_uid(data.get('uid')):
+        return web.json_response({'error':'uid required as a string or integer'}, status=400)
+    revoke_premium(data.get('uid'))
+    return web.json_response({'ok':True})
+
+def make_app():
+    app = web.Application()
+    if PROCESS_ROLE in ('all', 'api'):
+        app.add_routes(routes)
+    else:
+        app.router.add_get('/metrics', api_metrics)
+    if BOT_MODE == 'webhook' and PROCESS_ROLE in ('all', 'bot'):
+        app.router.add_post(WEBHOOK_PATH, webhook_handler)
+        app.router.add_get('/webhook/metrics', webhook_metrics)
+    return app
+
+async def serve_api():
+    runner = web.AppRunner(make_app())
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', SERVER_PORT, reuse_port=SERVER_REUSE_PORT or None).start()
+    return runner
+
+async def wait_for_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
 
 # --- Runner ---
+async def run_api():
+    runner = await serve_api()
+    await wait_for_signal()
+    await runner.cleanup()
+    await bot.session.close()
+
+async def run_webhook():
+    runner = await serve_api()
+    update_queue.start()
+    await dp.emit_startup(bot=bot)
+    await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+    await wait_for_signal()
+    logging.info('webhook: draining %s queued updates', update_queue.queue.qsize())
+    await update_queue.drain(DRAIN_TIMEOUT)
+    await runner.cleanup()
+    await dp.emit_shutdown(bot=bot)
+    await bot.session.close()
+
+async def run_polling():
+    runner = await serve_api()
+    try:
+        await bot.delete_webhook()  # getUpdates is refused while a webhook is set
+        await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+
 def start_bot():
-    asyncio.run(dp.start_polling(bot))
+    if PROCESS_ROLE == 'api':
+        asyncio.run(run_api())
+    elif BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            print('BOT_MODE=webhook needs WEBHOOK_URL (public https base URL).')
+            raise SystemExit(1)
+        asyncio.run(run_webhook())
+    else:
+        asyncio.run(run_polling())
 
 if __name__ == '__main__':
-    # run flask in background thread for Replit
-    t = Thread(target=run_flask, daemon=True)
-    t.start()
     print("Starting bot...")
     start_bot()